@@ -0,0 +1,124 @@
+"""
+Drives simulated players through /bet, the bill confirmation and the bet resolution against a fake instance.
+
+Usage: python -m benchmarks.bench_betting [--players 5000] [--latency 0.005] [--bill-delay 0.05] [--teams 2]
+"""
+import argparse
+import asyncio
+import random
+import time
+
+from argparse import Namespace
+
+from .fake_instance import FakeInstance, FakePlayer, create_app
+
+
+def percentile(values, percent):
+    if not values:
+        return 0.0
+
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(percent / 100 * (len(values) - 1))))]
+
+
+async def wait_for(condition, timeout=60):
+    started = time.monotonic()
+
+    while not condition() and time.monotonic() - started < timeout:
+        await asyncio.sleep(0.01)
+
+
+async def place_bets(app, instance, players, teams):
+    started = dict()
+
+    async def bettor(player):
+        started[player.login] = time.monotonic()
+        await app.place_bet(player, Namespace(amount=random.randint(10, 500), team=random.choice(teams)))
+
+    begin = time.monotonic()
+    await asyncio.gather(*[bettor(player) for player in players])
+    await wait_for(lambda: len(app.pending) == 0)
+    elapsed = time.monotonic() - begin
+
+    latencies = [instance.gbx.confirmed[login] - started[login] for login in started
+                 if login in instance.gbx.confirmed]
+
+    return elapsed, latencies
+
+
+async def run(players=5000, latency=0.005, bill_delay=0.05, global_rate=10 ** 6, teams=2, seed=1):
+    random.seed(seed)
+
+    # More than two teams simulate a market with many outcomes, e.g. one per player of a Rounds match
+    settings = dict(bet_config_teams=','.join('team{}'.format(i) for i in range(1, teams + 1))) if teams > 2 else dict()
+
+    instance = FakeInstance(latency=latency, bill_delay=bill_delay)
+    app = create_app(instance, bet_ledger_file='', bet_player_stats=False, bet_maximum_stake=10 ** 6,
+                     bet_admission_global_rate=global_rate, **settings)
+    await app.on_start()
+
+    admin = FakePlayer('admin', level=3)
+    bettors = [FakePlayer('player{}'.format(i)) for i in range(players)]
+    results = dict()
+
+    # Bet cycle resolved with a winner
+    await app.open_bet(admin, None)
+    elapsed, latencies = await place_bets(app, instance, bettors, app.teams)
+
+    # The command returns once the payouts are queued, the outbox worker sends them in the background
+    started = time.monotonic()
+    await app.resolve_bet(admin, Namespace(team=app.teams[0]))
+    results['resolve_command'] = time.monotonic() - started
+    await app.outbox.drain(60)
+    results['resolve'] = time.monotonic() - started
+
+    results.update(bets=len(latencies), elapsed=elapsed, bets_per_second=len(latencies) / elapsed if elapsed else 0,
+                   p50=percentile(latencies, 50), p99=percentile(latencies, 99))
+
+    # Bet cycle which is reset and refunded
+    instance.gbx.confirmed.clear()
+    await app.open_bet(admin, None)
+    await place_bets(app, instance, bettors, app.teams)
+
+    started = time.monotonic()
+    await app.reset_bet(admin, None)
+    await app.outbox.drain(60)
+    results['reset'] = time.monotonic() - started
+
+    results['gbx_calls'] = dict(instance.gbx.calls)
+    results['rejected'] = {dict(labels)['reason']: count for (name, labels), count in app.metrics.counters.items()
+                           if name == 'bets_rejected'}
+
+    await app.on_stop()
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description='BetMania load simulation')
+    parser.add_argument('--players', type=int, default=5000)
+    parser.add_argument('--latency', type=float, default=0.005, help='Simulated GBX round-trip latency in seconds')
+    parser.add_argument('--bill-delay', type=float, default=0.05, help='Delay until a bill is confirmed in seconds')
+    parser.add_argument('--global-rate', type=int, default=10 ** 6,
+                        help='Admission limit of bills per second, unlimited by default')
+    parser.add_argument('--teams', type=int, default=2, help='Number of teams players can bet on')
+    args = parser.parse_args()
+
+    results = asyncio.get_event_loop().run_until_complete(
+        run(args.players, args.latency, args.bill_delay, args.global_rate, args.teams))
+
+    print('Confirmed bets:      {}'.format(results['bets']))
+    print('Bets per second:     {:.1f}'.format(results['bets_per_second']))
+    print('Bet latency p50:     {:.1f}ms'.format(results['p50'] * 1000))
+    print('Bet latency p99:     {:.1f}ms'.format(results['p99'] * 1000))
+    print('Resolve command:     {:.1f}ms'.format(results['resolve_command'] * 1000))
+    print('Resolution time:     {:.1f}ms'.format(results['resolve'] * 1000))
+    print('Reset time:          {:.1f}ms'.format(results['reset'] * 1000))
+    print('Rejected bets:       {}'.format(', '.join('{}={}'.format(reason, count)
+                                                     for reason, count in sorted(results['rejected'].items()))
+                                           or 'none'))
+    print('GBX calls:           {}'.format(', '.join('{}={}'.format(method, count)
+                                                     for method, count in sorted(results['gbx_calls'].items()))))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,68 @@
+"""
+Measures the payout computation of a resolved bet, comparing the per-supporter float loop with the fixed-point
+largest-remainder allocation. Only the pool is used, no instance or server is needed.
+
+Usage: python -m benchmarks.bench_payouts [--supporters 100000] [--margin 5] [--runs 10]
+"""
+import argparse
+import random
+import time
+
+from betmania.pool import BetPool
+
+
+def float_payouts(pool, team):
+    # Payout computation used before the fixed-point allocation
+    quota = pool.quota(team)
+    return [(supporter, abs(int(round(amount * quota)))) for supporter, amount in pool.supporters[team].items()]
+
+
+def measure(func, runs):
+    timings = list()
+
+    for _ in range(runs):
+        started = time.perf_counter()
+        result = func()
+        timings.append(time.perf_counter() - started)
+
+    return min(timings), result
+
+
+def run(supporters=100000, margin=5, runs=10, seed=1):
+    random.seed(seed)
+
+    teams = ['blue', 'red']
+    pool = BetPool(teams, margin=margin, margin_relative=True)
+
+    for i in range(supporters * len(teams)):
+        pool.add(random.choice(teams), 'player{}'.format(i), random.randint(1, 2500))
+
+    float_time, float_result = measure(lambda: float_payouts(pool, 'blue'), runs)
+    fixed_time, fixed_result = measure(lambda: pool.payouts('blue'), runs)
+
+    return dict(supporters=len(pool.supporters['blue']), distributable=int(pool.stake), float_time=float_time,
+                float_sum=sum(amount for _, amount in float_result), fixed_time=fixed_time,
+                fixed_sum=sum(amount for _, amount in fixed_result))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='BetMania payout computation benchmark')
+    parser.add_argument('--supporters', type=int, default=100000)
+    parser.add_argument('--margin', type=int, default=5, help='Relative server margin in percent')
+    parser.add_argument('--runs', type=int, default=10)
+    args = parser.parse_args()
+
+    results = run(args.supporters, args.margin, args.runs)
+
+    print('Winning supporters:  {}'.format(results['supporters']))
+    print('Distributable stake: {}'.format(results['distributable']))
+    print('Float loop:          {:.1f}ms, payouts sum up to {} ({:+d})'
+          .format(results['float_time'] * 1000, results['float_sum'],
+                  results['float_sum'] - results['distributable']))
+    print('Fixed-point:         {:.1f}ms, payouts sum up to {} ({:+d})'
+          .format(results['fixed_time'] * 1000, results['fixed_sum'],
+                  results['fixed_sum'] - results['distributable']))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,164 @@
+"""
+Local stand-in for a PyPlanet instance connected to a dedicated server. GBX calls are answered after a configurable
+latency, bills sent with SendBill are confirmed through a delayed bill_updated signal. Without a bill delay, bills stay
+unconfirmed until update_bill is called.
+"""
+import asyncio
+import itertools
+import math
+import time
+
+from collections import Counter, defaultdict
+
+from pyplanet.apps.core.maniaplanet import callbacks as mp_signals
+
+import betmania
+
+
+class FakePlayer:
+    def __init__(self, login, nickname=None, level=0):
+        self.login = login
+        self.nickname = nickname or login
+        self.level = level
+
+
+class FakeQuery:
+    def __init__(self, gbx, method, *args):
+        self.gbx = gbx
+        self.method = method
+        self.args = args
+
+    def __await__(self):
+        return self.gbx(self.method, *self.args).__await__()
+
+
+class FakeGbx:
+    def __init__(self, instance, latency=0.005, bill_delay=0.05, refuse_every=0, planets=10 ** 9):
+        self.instance = instance
+        self.latency = latency
+        self.bill_delay = bill_delay
+        self.refuse_every = refuse_every
+        self.planets = planets
+
+        self.bill_ids = itertools.count(1)
+        self.bills = dict()
+        self.sent = defaultdict(list)
+        self.calls = Counter()
+        self.confirmed = dict()
+        self.paid = defaultdict(int)
+
+    def prepare(self, method, *args):
+        return FakeQuery(self, method, *args)
+
+    async def __call__(self, method, *args):
+        await asyncio.sleep(self.latency)
+        return self.handle(method, *args)
+
+    async def multicall(self, *queries):
+        await asyncio.sleep(self.latency)
+        return [self.handle(query.method, *query.args) for query in queries]
+
+    def handle(self, method, *args):
+        self.calls[method] += 1
+
+        if method == 'SendBill':
+            login, amount = args[0], args[1]
+            bill_id = next(self.bill_ids)
+            state = 6 if self.refuse_every and bill_id % self.refuse_every == 0 else 4
+            self.bills[bill_id] = dict(login=login, amount=amount, state=1)
+            self.sent[login].append(bill_id)
+
+            if self.bill_delay is not None:
+                asyncio.get_event_loop().call_later(self.bill_delay, self.update_bill, bill_id, state)
+
+            return bill_id
+
+        if method == 'GetBillState':
+            bill = self.bills.get(args[0], dict(state=0))
+            return dict(State=bill['state'], StateName='', TransactionId=0)
+
+        if method == 'GetServerPlanets':
+            return self.planets
+
+        if method == 'Pay':
+            login, amount = args[0], args[1]
+            self.planets -= amount + 2 + math.floor(amount * 0.05)
+            self.paid[login] += amount
+            return next(self.bill_ids)
+
+        return True
+
+    def update_bill(self, bill_id, state):
+        bill = self.bills[bill_id]
+        bill['state'] = state
+
+        if state == 4:
+            self.confirmed[bill['login']] = time.monotonic()
+
+        self.instance.signals.fire(mp_signals.other.bill_updated, bill_id=bill_id, state=state, state_name='',
+                                   transaction_id=0)
+
+
+class FakeSignals:
+    def __init__(self):
+        self.listeners = defaultdict(list)
+
+    def listen(self, signal, target):
+        self.listeners[signal].append(target)
+
+    def fire(self, signal, **kwargs):
+        for target in self.listeners[signal]:
+            asyncio.ensure_future(target(**kwargs))
+
+
+class FakeSettings:
+    async def register(self, *settings):
+        pass
+
+
+class FakeContext:
+    def __init__(self, signals):
+        self.signals = signals
+        self.setting = FakeSettings()
+        self.ui = None
+
+
+class FakeManager:
+    async def register(self, *args, **kwargs):
+        pass
+
+
+class FakeInstance:
+    def __init__(self, **kwargs):
+        self.gbx = FakeGbx(self, **kwargs)
+        self.signals = FakeSignals()
+        self.permission_manager = FakeManager()
+        self.command_manager = FakeManager()
+        self.chat_messages = 0
+
+    def chat(self, message, *logins):
+        self.chat_messages += 1
+        return self.gbx.prepare('ChatSendServerMessageToLogin' if logins else 'ChatSendServerMessage', message)
+
+
+def create_app(instance, **settings):
+    """
+    Creates a BetMania app bound to the given fake instance. Settings use their defaults unless overridden by keyword.
+    """
+    app = betmania.BetMania('betmania', betmania, instance)
+    app.context = FakeContext(instance.signals)
+
+    for attribute in dir(app):
+        if attribute.startswith('setting_'):
+            setting = getattr(app, attribute)
+            value = settings.get(setting.key, setting.default)
+            setting.get_value = static_value(value)
+
+    return app
+
+
+def static_value(value):
+    async def get_value(*args, **kwargs):
+        return value
+
+    return get_value
@@ -0,0 +1,196 @@
+"""
+Replays a session recorded with the bet_trace_file setting against a fake instance. Commands, bill updates and flow
+signals are issued at their recorded offsets, so a production session can be profiled locally.
+
+Usage: python -m benchmarks.replay TRACE [--speed 1.0] [--latency 0.005] [--profile FILE]
+"""
+import argparse
+import asyncio
+import cProfile
+import json
+import logging
+import time
+
+from argparse import Namespace
+from collections import defaultdict
+
+from pyplanet.apps.core.maniaplanet import callbacks as mp_signals
+from pyplanet.apps.core.trackmania import callbacks as tm_signals
+
+from .fake_instance import FakeInstance, FakePlayer, create_app
+
+logger = logging.getLogger(__name__)
+
+SIGNALS = dict(player_connect=mp_signals.player.player_connect,
+               player_info_changed=mp_signals.player.player_info_changed, round_start=mp_signals.flow.round_start,
+               scores=tm_signals.scores)
+
+
+def load(path):
+    with open(path) as file:
+        entries = [json.loads(line) for line in file if line.strip()]
+
+    # A trace file may hold several recordings, only the last one is replayed
+    starts = [index for index, entry in enumerate(entries) if entry[1] == 'start']
+
+    if not starts:
+        raise ValueError('{} does not contain a recording'.format(path))
+
+    return entries[starts[-1]][2], entries[starts[-1] + 1:]
+
+
+class Replay:
+    def __init__(self, header, entries, speed=1.0, latency=0.005):
+        self.entries = entries
+        self.speed = speed
+
+        self.instance = FakeInstance(latency=latency, bill_delay=None)
+        self.app = create_app(self.instance, bet_ledger_file='', bet_player_stats=False, bet_trace_file='',
+                              bet_metrics_file='', bet_shared_pool_file='', bet_show_widget=False,
+                              **header.get('settings', dict()))
+
+        self.players = dict()
+        self.bills = dict()
+        self.tasks = list()
+        self.failed = 0
+        self.missing = 0
+
+        # Bills are matched by their order per login, the recorded bill ids differ from the replayed ones
+        self.sent = defaultdict(int)
+
+        for entry in entries:
+            if entry[1] == 'gbx' and entry[2] == 'SendBill' and entry[4] is not None:
+                login = entry[3][0]
+                self.bills[entry[4]] = (login, self.sent[login])
+                self.sent[login] += 1
+
+    @property
+    def unmatched(self):
+        # Bills sent by the replay only, e.g. because the admission control let a bet pass which was rejected in the
+        # recording. The recording has no update for them.
+        return sum(max(0, len(bill_ids) - self.sent[login]) for login, bill_ids in self.instance.gbx.sent.items())
+
+    def player(self, data):
+        if data is None:
+            return None
+
+        if data['login'] not in self.players:
+            self.players[data['login']] = FakePlayer(**data)
+
+        return self.players[data['login']]
+
+    async def run(self):
+        await self.app.on_start()
+
+        started = time.monotonic()
+
+        for entry in self.entries:
+            delay = entry[0] / self.speed - (time.monotonic() - started)
+
+            if delay > 0:
+                await asyncio.sleep(delay)
+
+            self.dispatch(entry[1], *entry[2:])
+
+        await asyncio.gather(*self.tasks)
+        await self.drain()
+
+        elapsed = time.monotonic() - started
+        await self.app.on_stop()
+
+        return elapsed
+
+    def dispatch(self, kind, name, *payload):
+        if kind == 'cmd':
+            player, data = payload
+            command = getattr(self.app, name)
+            self.tasks.append(asyncio.ensure_future(self.command(command, self.player(player),
+                                                                 Namespace(**data) if data is not None else None)))
+
+        elif kind == 'sig' and name == 'bill_updated':
+            self.tasks.append(asyncio.ensure_future(self.update_bill(**payload[0])))
+
+        elif kind == 'sig' and name in SIGNALS:
+            kwargs = payload[0]
+
+            if 'player' in kwargs:
+                kwargs['player'] = self.player(dict(login=kwargs['player']))
+
+            self.instance.signals.fire(SIGNALS[name], **kwargs)
+
+    async def command(self, command, player, data):
+        try:
+            await command(player, data)
+        except Exception:
+            # Views can't be shown without a UI manager, they are counted but don't abort the replay
+            logger.debug('Replayed command {} failed'.format(command.__name__), exc_info=True)
+            self.failed += 1
+
+    async def update_bill(self, bill_id, state, **kwargs):
+        if bill_id not in self.bills:
+            return
+
+        login, index = self.bills[bill_id]
+
+        # The replayed bill may still be on its way when the recorded update is due
+        for _ in range(500):
+            if len(self.instance.gbx.sent[login]) > index:
+                self.instance.gbx.update_bill(self.instance.gbx.sent[login][index], state)
+                return
+
+            await asyncio.sleep(0.01)
+
+        self.missing += 1
+
+    async def drain(self, timeout=60):
+        started = time.monotonic()
+
+        while len(self.app.pending) > self.unmatched and time.monotonic() - started < timeout:
+            await asyncio.sleep(0.01)
+
+        await self.app.outbox.drain(max(0.0, timeout - (time.monotonic() - started)))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='BetMania session replay')
+    parser.add_argument('trace', help='Trace file written with the bet_trace_file setting')
+    parser.add_argument('--speed', type=float, default=1.0, help='Replay speed relative to the recording')
+    parser.add_argument('--latency', type=float, default=0.005, help='Simulated GBX round-trip latency in seconds')
+    parser.add_argument('--profile', help='Writes cProfile stats of the replay to this file')
+    args = parser.parse_args()
+
+    header, entries = load(args.trace)
+    replay = Replay(header, entries, args.speed, args.latency)
+    profiler = cProfile.Profile() if args.profile else None
+
+    if profiler:
+        profiler.enable()
+
+    elapsed = asyncio.get_event_loop().run_until_complete(replay.run())
+
+    if profiler:
+        profiler.disable()
+        profiler.dump_stats(args.profile)
+
+    duration = entries[-1][0] if entries else 0.0
+
+    print('Replayed entries:    {}'.format(len(entries)))
+    print('Failed commands:     {}'.format(replay.failed))
+    print('Trace duration:      {:.2f}s'.format(duration))
+    print('Replay duration:     {:.2f}s at {}x'.format(elapsed, args.speed))
+    print('Pending bills:       {}'.format(len(replay.app.pending)))
+    print('Diverged bills:      {} sent only by the replay, {} not sent by the replay'
+          .format(replay.unmatched, replay.missing))
+
+    for key in sorted(replay.app.metrics.timings):
+        name, labels = key
+
+        if name == 'gbx_call':
+            summary = replay.app.metrics.summary(key)
+            print('GBX {:<20} {} calls, p50 {:.1f}ms, p99 {:.1f}ms'
+                  .format(dict(labels).get('method', '') + ':', summary['count'], summary['p50'] * 1000,
+                          summary['p99'] * 1000))
+
+
+if __name__ == '__main__':
+    main()
@@ -1,36 +1,78 @@
 import asyncio
-import math
+import logging
+import time
+
+from collections import deque
 
 from pyplanet.apps.config import AppConfig
-from .views import SupportersListView
+from .admission import Admission
+from .autobet import AutoBet
+from .bills import PendingBills
+from .chat import ChatQueue
+from .history import QuotaHistory, sparkline
+from .ledger import BetLedger
+from .locks import ShardedLock
+from .market import Market, MarketRegistry
+from .metrics import Metrics
+from .outbox import PayoutOutbox
+from .players import NicknameCache
+from .recorder import TraceRecorder
+from .shared import SharedPool, SqlitePoolBackend
+from .stats import BetStats
+from .views import BetLeaderboardView, ServerInfoWidget, SupportersListView
 from pyplanet.contrib.command import Command
 from pyplanet.contrib.setting import Setting
 
 from pyplanet.apps.core.maniaplanet import callbacks as mp_signals
+from pyplanet.apps.core.trackmania import callbacks as tm_signals
+
+logger = logging.getLogger(__name__)
+
+ADMISSION_MESSAGES = {
+    'player_rate': 'You\'re betting too fast. Please wait a moment before placing your next bet.',
+    'global_rate': 'Too many bets are being placed right now. Please try again in a moment.',
+    'pending': 'You still have unpaid bills. Please pay or cancel them before placing another bet.',
+}
 
 
 class BetMania(AppConfig):
     # default settings
     name = 'pyplanet.apps.contrib.betmania'
     game_dependencies = ['trackmania']
-    app_dependencies = ['core.maniaplanet']
+    app_dependencies = ['core.maniaplanet', 'core.trackmania']
 
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
 
         # Init vars
-        self.bet_open = False
-        self.bet_current = False
-        self.bets = dict()
-        self.min_bet = 1
-        self.max_bet = 2500
-        self.stack = dict()
-        self.stake = 0
-        self.supporters = dict()
+        self.markets = MarketRegistry()
+        self.markets.add(Market(self.markets.default, list(), dict(), default=True))
+        self.pending = PendingBills()
+        self.reconcile_task = None
+        self.bet_margin = 0
+        self.bet_margin_relative = False
+        self.bet_minimum_stake = 1
+        self.bet_maximum_stake = 2500
         self.teams = list()
         self.team_colors = dict()
 
-        self.lock = asyncio.Lock()
+        self.state_lock = asyncio.Lock()
+        self.player_locks = ShardedLock()
+        self.admission = Admission()
+        self.outbox = PayoutOutbox(self)
+        self.ledger = None
+        self.shared_pool = None
+        self.restored_pushes = dict()
+        self.chat_queue = ChatQueue(self)
+        self.nicknames = NicknameCache()
+        self.stats = BetStats()
+        self.widget = None
+        self.autobet = AutoBet(self)
+        self.metrics = Metrics()
+        self.recorder = TraceRecorder()
+        self.metrics_task = None
+        self.history_task = None
+        self.quota_archive = deque(maxlen=20)
 
         self.setting_bet_config_teams = Setting(
             'bet_config_teams', 'Configure the available betting targets (teams)', Setting.CAT_BEHAVIOUR, type=str,
@@ -48,32 +90,129 @@ class BetMania(AppConfig):
             'bet_margin', 'Sets the server margin for all bets.', Setting.CAT_BEHAVIOUR, type=int,
             description='Defines the amount of planets deducted as transaction fees from the total stake before a bet '
                         'payout. Use values between 1 and 100 if bet_margin_relative is activated.',
-            default=0,
+            default=0, change_target=self.refresh_settings
         )
 
         self.setting_bet_margin_relative = Setting(
             'bet_margin_relative', 'Use bet_margin as a relative amount', Setting.CAT_BEHAVIOUR, type=bool,
             description='If activated, bet_margin is handled as a relative amount (xx % of the stake). By default bet_'
                         'margin will be used as an absolute amount (xxx planets).',
-            default=False,
+            default=False, change_target=self.refresh_settings
         )
 
         self.setting_bet_minimum_stake = Setting(
             'bet_minimum_stake', 'Sets the minimum amount of planets needed for placing a bet.', Setting.CAT_BEHAVIOUR,
             type=int, description='Defines the minimum amount of planets needed for placing a bet. A value of 1 '
                                   'accepts all stakes.',
-            default=1,
+            default=1, change_target=self.refresh_settings
         )
 
         self.setting_bet_maximum_stake = Setting(
             'bet_maximum_stake', 'Sets the maximum amount of planets allowed for placing a bet.', Setting.CAT_BEHAVIOUR,
             type=int, description='Defines the maximum amount of planets allowed for placing a bet.',
-            default=2500,
+            default=2500, change_target=self.refresh_settings
+        )
+
+        self.setting_bet_admission_player_rate = Setting(
+            'bet_admission_player_rate', 'Sets the maximum amount of bets per player and minute', Setting.CAT_BEHAVIOUR,
+            type=int, description='Defines how many /bet commands a player may use per minute. Up to 3 bets in a row '
+                                  'are accepted before the limit applies.',
+            default=12, change_target=self.refresh_settings
+        )
+
+        self.setting_bet_admission_global_rate = Setting(
+            'bet_admission_global_rate', 'Sets the maximum amount of bills sent per second', Setting.CAT_BEHAVIOUR,
+            type=int, description='Defines how many bills are sent to all players per second at most. Further bets are '
+                                  'rejected before they reach the dedicated server.',
+            default=50, change_target=self.refresh_settings
+        )
+
+        self.setting_bet_max_pending_bills = Setting(
+            'bet_max_pending_bills', 'Sets the maximum amount of unpaid bills per player', Setting.CAT_BEHAVIOUR,
+            type=int, description='Defines how many unpaid bills a player may have at the same time. Further bets are '
+                                  'rejected until a bill is paid or refused.',
+            default=2, change_target=self.refresh_settings
+        )
+
+        self.setting_bet_chat_rate = Setting(
+            'bet_chat_rate', 'Sets the maximum amount of chat messages per second', Setting.CAT_BEHAVIOUR, type=int,
+            description='Defines how many chat messages BetMania sends per second at most. Further messages are '
+                        'queued and sent later.',
+            default=10, change_target=self.refresh_settings
+        )
+
+        self.setting_bet_chat_summary_interval = Setting(
+            'bet_chat_summary_interval', 'Sets the interval of bet announcements', Setting.CAT_BEHAVIOUR, type=int,
+            description='Defines the interval (in seconds) in which new bets are announced. All bets placed within '
+                        'this interval are merged into a single announcement.',
+            default=2, change_target=self.refresh_settings
+        )
+
+        self.setting_bet_auto_mode = Setting(
+            'bet_auto_mode', 'Enables the Auto-Bet mode', Setting.CAT_BEHAVIOUR, type=bool,
+            description='If activated, a bet is opened at the start of each round, closed after bet_auto_close_after '
+                        'seconds and resolved with the result of the round.',
+            default=False, change_target=self.refresh_settings
+        )
+
+        self.setting_bet_auto_close_after = Setting(
+            'bet_auto_close_after', 'Sets the betting time of the Auto-Bet mode', Setting.CAT_BEHAVIOUR, type=int,
+            description='Defines after how many seconds a bet opened by the Auto-Bet mode is closed.',
+            default=30, change_target=self.refresh_settings
+        )
+
+        self.setting_bet_bill_timeout = Setting(
+            'bet_bill_timeout', 'Sets the timeout of unpaid bills', Setting.CAT_BEHAVIOUR, type=int,
+            description='Defines after how many seconds an unpaid bill is checked against the server. Bills which are '
+                        'still unpaid after ten timeouts are dropped.',
+            default=120, change_target=self.refresh_settings
+        )
+
+        self.setting_bet_ledger_file = Setting(
+            'bet_ledger_file', 'Sets the file used as bet ledger', Setting.CAT_BEHAVIOUR, type=str,
+            description='Defines the SQLite file all bet events are written to. An unresolved bet is restored from '
+                        'this file after a restart. Leave empty to disable the ledger. Changes require a restart.',
+            default='betmania_ledger.sqlite3',
+        )
+
+        self.setting_bet_shared_pool_file = Setting(
+            'bet_shared_pool_file', 'Sets the file of the pool shared with other servers', Setting.CAT_BEHAVIOUR,
+            type=str, description='Defines a SQLite file shared by the BetMania instances of several servers on the '
+                                  'same host. Bets on markets with the same name are pooled and resolved by the server '
+                                  'which resolves first. Leave empty to disable. Changes require a restart.',
+            default='',
+        )
+
+        self.setting_bet_shared_pool_node = Setting(
+            'bet_shared_pool_node', 'Sets the name of this server in the shared pool', Setting.CAT_BEHAVIOUR, type=str,
+            description='Defines the name this server uses in the shared pool. Defaults to the server login.',
+            default='',
+        )
+
+        self.setting_bet_player_stats = Setting(
+            'bet_player_stats', 'Records betting stats of each player', Setting.CAT_BEHAVIOUR, type=bool,
+            description='If activated, the wagered and won planets, bets and wins of each player are added up in the '
+                        'database after every resolved bet. Shown by /betstats.',
+            default=True,
+        )
+
+        self.setting_bet_trace_file = Setting(
+            'bet_trace_file', 'Sets the file betting sessions are recorded to', Setting.CAT_BEHAVIOUR, type=str,
+            description='Defines a file all BetMania commands, GBX calls and signals are recorded to, so a session can '
+                        'be replayed with benchmarks.replay. Leave empty to disable.',
+            default='', change_target=self.open_trace
+        )
+
+        self.setting_bet_metrics_file = Setting(
+            'bet_metrics_file', 'Sets the file metrics are written to', Setting.CAT_BEHAVIOUR, type=str,
+            description='Defines a file the BetMania metrics are written to every 15 seconds, using the Prometheus '
+                        'text format. Leave empty to disable.',
+            default='',
         )
 
         self.setting_show_widget = Setting(
             'bet_show_widget', 'Shows / Hides the BetMania widget', Setting.CAT_BEHAVIOUR, type=bool,
-            description='Shows / Hides the BetMania widget (currently not used).',
+            description='Shows / Hides the BetMania widget displaying the current stake and quotas.',
             default=False, change_target=self.toggle_widget
         )
 
@@ -83,324 +222,876 @@ class BetMania(AppConfig):
         await self.instance.permission_manager.register('close_bet', 'Closes an open bet.', app=self, min_level=1)
         await self.instance.permission_manager.register('resolve_bet', 'Resolves a bet.', app=self, min_level=3)
 
-        # Registers available chat commands
-        await self.instance.command_manager.register(
+        # Registers available chat commands. Their targets are wrapped by the trace recorder.
+        commands = [
             Command(command='openbet', target=self.open_bet, perms='betmania:open_bet', admin=True,
-                    description='Opens up a new bet and clears all related variables.'),
+                    description='Opens up a new bet and clears all related variables.')
+            .add_param(name='market', required=False, type=str, help='Name of the market, defaults to the main market')
+            .add_param(name='teams', required=False, type=str, help='Comma separated teams of a new market'),
             Command(command='closebet', target=self.close_bet, perms='betmania:close_bet', admin=True,
-                    description='Closes an open bet and prevents players from placing new bets.'),
+                    description='Closes an open bet and prevents players from placing new bets.')
+            .add_param(name='market', required=False, type=str, help='Name of the market, defaults to the main market'),
             Command(command='resolvebet', aliases=['resolve'], target=self.resolve_bet, perms='betmania:resolve_bet',
                     admin=True, description='Closes and resolves a bet.')
-            .add_param(name='team', required=True, type=str, help='Specify the winning team'),
+            .add_param(name='team', required=True, type=str, help='Specify the winning team')
+            .add_param(name='market', required=False, type=str, help='Name of the market, defaults to the main market'),
             Command(command='resetbet', target=self.reset_bet, perms='betmania:resolve_bet', admin=True,
-                    description='Resets an already opened bet. Use only when necessary!'),
+                    description='Resets an already opened bet. Use only when necessary!')
+            .add_param(name='market', required=False, type=str, help='Name of the market, defaults to the main market'),
             Command(command='bet', target=self.place_bet,
                     description='Places a configurable amount of planets on a bet.')
             .add_param(name='amount', required=True, type=int, help='Enter here how many planets you want to bet')
             .add_param(name='team', required=True, type=str,
-                       help='Enter the team you want to bet for. You\'ll receive a payout if your specified team wins.'),
+                       help='Enter the team you want to bet for. You\'ll receive a payout if your specified team wins.')
+            .add_param(name='market', required=False, type=str,
+                       help='Enter the market you want to bet on, defaults to the main market'),
+            Command(command='history', namespace='quota', target=self.show_quota_history,
+                    description='Shows how the quotas have moved during the current or the last bet.')
+            .add_param(name='market', required=False, type=str, help='Name of the market, defaults to the main market'),
             Command(command='quota', target=self.show_bet_quota,
-                    description='Returns the current payout quotas for both teams.'),
+                    description='Returns the current payout quotas for both teams.')
+            .add_param(name='market', required=False, type=str, help='Name of the market, defaults to the main market'),
             Command(command='supporters', target=self.show_supporters,
                     description='Shows a list of all current supporters of a specified team.')
-            .add_param(name='team', required=True, type=str, help='Enter the team whose supporters you want to see.'),
+            .add_param(name='team', required=True, type=str, help='Enter the team whose supporters you want to see.')
+            .add_param(name='market', required=False, type=str, help='Name of the market, defaults to the main market'),
+            Command(command='markets', target=self.show_markets, description='Lists all markets with an active bet.'),
+            Command(command='top', namespace='betstats', target=self.show_leaderboard,
+                    description='Shows the players with the highest net profit from bets.'),
+            Command(command='betstats', target=self.show_player_stats,
+                    description='Shows your betting stats.'),
             Command(command='bmdebug', target=self.debug, perms='betmania:resolve_bet', admin=True,
                     description='For development purposes.'),
+            Command(command='bmstats', target=self.show_stats, perms='betmania:resolve_bet', admin=True,
+                    description='Shows timings and counters of the betting system.'),
             Command(command='betmania', target=self.betmania_info, description='Displays intro message'),
-        )
+        ]
+
+        for command in commands:
+            command.target = self.recorder.command(command.target)
+
+        await self.instance.command_manager.register(*commands)
 
         await self.context.setting.register(self.setting_bet_config_teams, self.setting_bet_config_team_colors,
                                             self.setting_bet_margin, self.setting_bet_margin_relative,
                                             self.setting_bet_minimum_stake, self.setting_bet_maximum_stake,
-                                            self.setting_show_widget)
-
+                                            self.setting_bet_admission_player_rate,
+                                            self.setting_bet_admission_global_rate, self.setting_bet_max_pending_bills,
+                                            self.setting_bet_chat_rate, self.setting_bet_chat_summary_interval,
+                                            self.setting_bet_auto_mode, self.setting_bet_auto_close_after,
+                                            self.setting_bet_bill_timeout, self.setting_bet_ledger_file,
+                                            self.setting_bet_shared_pool_file, self.setting_bet_shared_pool_node,
+                                            self.setting_bet_player_stats, self.setting_bet_trace_file,
+                                            self.setting_bet_metrics_file, self.setting_show_widget)
+
+        await self.refresh_settings()
         await self.reconfigure_teams()
+        await self.open_ledger()
+        await self.open_shared_pool()
+        await self.open_trace()
+        self.chat_queue.start()
+        self.outbox.start()
+        self.reconcile_task = asyncio.ensure_future(self.reconcile_bills())
+        self.metrics_task = asyncio.ensure_future(self.write_metrics())
+        self.history_task = asyncio.ensure_future(self.sample_quotas())
 
         # Register callback.
-        self.context.signals.listen(mp_signals.other.bill_updated, self.receive_bet)
+        self.context.signals.listen(mp_signals.other.bill_updated,
+                                    self.recorder.signal('bill_updated', self.receive_bet))
+        self.context.signals.listen(mp_signals.player.player_info_changed,
+                                    self.recorder.signal('player_info_changed', self.player_info_changed))
+        self.context.signals.listen(mp_signals.player.player_connect,
+                                    self.recorder.signal('player_connect', self.player_connect))
+        self.context.signals.listen(mp_signals.flow.round_start,
+                                    self.recorder.signal('round_start', self.autobet.round_start))
+        self.context.signals.listen(tm_signals.scores, self.recorder.signal('scores', self.autobet.scores))
+
+        self.widget = ServerInfoWidget(self)
+        await self.toggle_widget()
 
-        await self.instance.chat('$s$FFF//Bet$1EFMania $FFFBetting System v$FF00.3.3 online')
+        self.chat_queue.send('$s$FFF//Bet$1EFMania $FFFBetting System v$FF00.3.3 online')
 
     async def open_bet(self, player, data, **kwargs):
-        if not self.bet_current:
+        market_id = getattr(data, 'market', None) or self.markets.default
+        teams = getattr(data, 'teams', None)
+        market = self.markets.get(market_id)
+
+        if market is None:
+            # Markets are created on their first //openbet, optionally with their own comma separated teams
+            market = self.markets.add(Market(market_id, teams.split(',') if teams else self.teams, self.team_colors,
+                                             self.bet_margin, self.bet_margin_relative))
+
+        if not market.bet_current:
             # Initializes vars and sets bet to open (it's more or less an init-function)
-            await self.reconfigure_teams()
-
-            self.bet_open = True
-            self.bet_current = True
-            self.bets.clear()
-            self.min_bet = await self.setting_bet_minimum_stake.get_value()
-            self.max_bet = await self.setting_bet_maximum_stake.get_value()
-            self.stake = 0
-
-            await self.instance.chat('$s$FFF//Bet$1EFMania$FFF: BET IS NOW OPEN! //')
-            await self.instance.chat(
-                '$FFFA bet has been opened. Place your stakes now with \'/bet <amount> <team>\'. '
+            if teams:
+                market.configure_teams(teams.split(','), self.team_colors)
+            elif market.default:
+                await self.reconfigure_teams()
+            else:
+                market.pool.reset(market.teams)
+
+            market.bet_open = True
+            market.bet_current = True
+            market.min_bet = self.bet_minimum_stake
+            market.max_bet = self.bet_maximum_stake
+            market.cycle = None
+            market.history = QuotaHistory(market.teams)
+            market.new_bet()
+            self.record('open', market=market.id, bet_id=market.bet_id, teams=market.teams, min_bet=market.min_bet,
+                        max_bet=market.max_bet)
+
+            if self.shared_pool:
+                await self.shared_pool.join(market)
+                self.record('join', market=market.id, cycle=market.cycle)
+
+            self.chat_queue.send('{}BET IS NOW OPEN! //'.format(market.prefix))
+            self.chat_queue.send(
+                '$FFFA bet has been opened. Place your stakes now with \'/bet <amount> <team>{}\'. '
                 'Minimum stake for this bet is $1EF{} $FFFplanets, maximum stake is $FE1{} $FFFplanets. Good luck!'
-                .format(self.min_bet, self.max_bet))
+                .format('' if market.default else ' ' + market.id, market.min_bet, market.max_bet))
 
         else:
-            await self.instance.chat(
-                '$s$FFF//Bet$1EFMania$FFF: Previously unresolved bet found. I\'ll reopen that... //', player)
-            self.bet_open = True
-            await self.instance.chat('$s$FFF//Bet$1EFMania$FFF: BET HAS BEEN REOPENED! //')
+            self.chat_queue.send(
+                '{}Previously unresolved bet found. I\'ll reopen that... //'.format(market.prefix), player)
+            market.bet_open = True
+            self.record('reopen', market=market.id)
+            self.chat_queue.send('{}BET HAS BEEN REOPENED! //'.format(market.prefix))
 
     async def close_bet(self, player, data, **kwargs):
         # Sets bet to closed without resolving it
-        if self.bet_open:
-            self.bet_open = False
-            await self.instance.chat('$s$FFF//Bet$1EFMania$FFF: BET IS NOW CLOSED!')
+        market = await self.get_market(player, data)
+
+        if market is None:
+            return
+
+        if market.bet_open:
+            market.bet_open = False
+            self.record('close', market=market.id)
+            self.chat_queue.flush_announcements()
+            self.chat_queue.send('{}BET IS NOW CLOSED!'.format(market.prefix))
         else:
-            await self.instance.chat('$s$FFF//Bet$1EFMania$FFF: We don\'t have an active bet at the moment.', player)
+            self.chat_queue.send('{}We don\'t have an active bet at the moment.'.format(market.prefix), player)
 
     async def resolve_bet(self, player, data, **kwargs):
         # Sets bet to closed and immediately resolves it
-        if self.bet_current:
-            self.bet_open = False
+        market = await self.get_market(player, data)
+
+        if market is None:
+            return
+
+        if market.bet_current:
+            was_open, market.bet_open = market.bet_open, False
 
-            if data.team in self.teams:
-                # data.team contains the winning team as provided by /resolve <team>
-                self.stake = await self.calc_stake()
+            if data.team in market.teams:
+                # data.team contains the winning team as provided by /resolve <team>. The bet is marked as resolved
+                # before the payouts are computed, so a second /resolve can't pay out the same bet twice
+                market.bet_current = False
 
-                if self.stack[data.team] > 0:
-                    quota = round(self.stake / self.stack[data.team], 3)
+                if self.shared_pool and market.cycle in self.shared_pool.markets:
+                    # The quota and the payouts of this server are computed from the stakes of all servers
+                    settlement = await self.settle_shared(player, market, data.team, was_open)
 
-                    await self.instance.chat('$s$FFF//Bet$1EFMania$FFF: BET PAYOUTS!!!')
+                    if settlement is None:
+                        return
 
-                    await self.instance.chat(
-                        '$s$FFF//Bet$1EFMania$FFF: Team {}{} $FFFhas won the tournament. Quota was {}.'
-                        .format(self.team_colors[data.team], data.team, str(quota)))
+                    quota, payouts = settlement
+                else:
+                    quota = market.pool.quota(data.team)
+                    payouts = market.pool.payouts(data.team) if quota is not None else list()
 
-                    for supporter in self.supporters[data.team]:
-                        try:
-                            amount = abs(int(round(self.supporters[data.team][supporter] * quota)))
-                            planets = await self.instance.gbx('GetServerPlanets')
+                # The bet is only removed and written to the ledger once it is settled
+                self.markets.remove(market.id)
+                self.record('resolve', market=market.id, team=data.team)
+                self.archive_history(market, data.team)
 
-                            await self.instance.chat(
-                                '$s$FFF//Bet$1EFMania$FFF: Congrats! Team {}{} $FFFwon. You receive $222{} $FFFplanets as your bet payout.'
-                                .format(self.team_colors[data.team], data.team, str(amount)), supporter)
+                self.chat_queue.flush_announcements()
 
-                            if amount <= (planets - 2 - math.floor(amount * 0.05)):
-                                async with self.lock:
-                                    await self.instance.gbx('Pay', supporter, amount, 'Bet payout from the server')
+                if quota is not None:
+                    self.chat_queue.send('{}BET PAYOUTS!!!'.format(market.prefix))
+                    self.chat_queue.send(
+                        '{}Team {} $FFFhas won the tournament. Quota was {}.'
+                        .format(market.prefix, market.label(data.team), str(quota)))
 
-                        except ValueError:
-                            await self.instance.chat('$z$s$fff» $i$f00The amount should be a numeric value.', player)
+                    # The payouts are sent by the outbox worker, the admin receives the report once they're done
+                    self.outbox.enqueue(
+                        'payout', payouts, 'Bet payout from the server', player=player,
+                        notice='{}Congrats! Team {} $FFFwon. You receive $222{{amount}} $FFFplanets as your bet '
+                               'payout.'.format(market.prefix, market.label(data.team)))
 
                 else:
-                    await self.instance.chat('$s$FFF//Bet$1EFMania$FFF: Total stake is zero, no payout this time!')
+                    self.chat_queue.send('{}Total stake is zero, no payout this time!'.format(market.prefix))
 
-                self.bet_current = False
+                await self.record_stats(market, data.team, payouts)
 
             else:
-                await self.instance.chat(
-                    '$s$FFF//Bet$1EFMania$FFF: Please specify the winning team. Allowed arguments are $1EF{}'
-                    .format('$FFF, $1EF'.join(self.teams)), player)
+                self.chat_queue.send(
+                    '{}Please specify the winning team. Allowed arguments are $1EF{}'
+                    .format(market.prefix, '$FFF, $1EF'.join(market.teams)), player)
         else:
-            await self.instance.chat(
-                '$s$FFF//Bet$1EFMania$FFF: There\'s no available bet at the moment that could be resolved.',
-                player)
+            self.chat_queue.send(
+                '{}There\'s no available bet at the moment that could be resolved.'.format(market.prefix), player)
 
     async def reset_bet(self, player, data, **kwargs):
         # Resets a bet and returns all bets to the respective players
-        if self.bet_current:
-            self.bet_open = False
-            self.bet_current = False
-            self.bets.clear()
-            self.stake = 0
+        market = await self.get_market(player, data)
+
+        if market is None:
+            return
 
-            for team in self.teams:
-                for supporter in self.supporters[team]:
-                    try:
-                        amount = abs(int(self.supporters[team][supporter]))
-                        planets = await self.instance.gbx('GetServerPlanets')
+        if market.bet_current:
+            was_open, market.bet_open = market.bet_open, False
+            market.bet_current = False
 
-                        if amount <= (planets - 2 - math.floor(amount * 0.05)):
-                            async with self.lock:
-                                await self.instance.gbx('Pay', supporter, amount, 'Bet payback from the server')
+            if self.shared_pool and market.cycle in self.shared_pool.markets:
+                settlement = await self.settle_shared(player, market, None, was_open)
 
-                    except ValueError:
-                        await self.instance.chat('$z$s$fff» $i$f00The amount should be a numeric value.', player)
+                if settlement is None:
+                    return
+
+                payouts = settlement[1]
+            else:
+                payouts = [(supporter, abs(int(amount))) for supporter, amount in market.pool.stakes()]
 
-                self.supporters[team].clear()
-                self.stack[team] = 0
+            self.markets.remove(market.id)
+            self.record('reset', market=market.id)
+            self.archive_history(market, None)
 
-            await self.instance.chat('$s$FFF//Bet$1EFMania$FFF: BET IS CANCELLED! You\'ll receive your Planets back.')
+            market.pool.reset(market.teams)
+
+            self.outbox.enqueue('refund', payouts, 'Bet payback from the server', player=player)
+
+            self.chat_queue.flush_announcements()
+            self.chat_queue.send('{}BET IS CANCELLED! You\'ll receive your Planets back.'.format(market.prefix))
+        else:
+            self.chat_queue.send('{}There\'s nothing to reset...'.format(market.prefix), player)
+
+    async def settle_shared(self, player, market, winner, was_open):
+        # Settles the market's cycle with the shared pool. Returns None if another server has settled it already or the
+        # backend failed, the market is left active in both cases.
+        try:
+            settlement = await self.shared_pool.settle(market, winner)
+        except Exception:
+            logger.exception('Could not settle market {} with the shared pool'.format(market.id))
+            settlement = None
+            message = 'The shared pool could not be reached, the bet is still active. Please try again.'
         else:
-            await self.instance.chat('$s$FFF//Bet$1EFMania$FFF: There\'s nothing to reset...', player)
+            message = 'This bet has already been settled by another server.'
+
+        if settlement is not None:
+            return settlement
+
+        # A bet settled by another server is closed with its result by the next sync, unless that happened already
+        if market.cycle in self.shared_pool.markets:
+            market.bet_open = was_open
+            market.bet_current = True
+
+        if player:
+            self.chat_queue.send('{}{}'.format(market.prefix, message), player)
+
+        return None
 
     async def show_bet_quota(self, player, data, **kwargs):
         # Outputs the current payout quotas for each team
-        if self.bet_current:
-            for team in self.teams:
-                if self.stack[team] > 0:
-                    quota = round(self.stake / self.stack[team], 3)
-                    await self.instance.chat('$s$FFF//Bet$1EFMania$FFF: Quota for {}{} $FFFwin is {}'
-                                             .format(self.team_colors[team], team, str(quota)), player)
+        market = await self.get_market(player, data)
+
+        if market is None:
+            return
+
+        if market.bet_current:
+            quotas = market.pool.quotas()
+
+            for team in market.teams:
+                if quotas[team] is not None:
+                    self.chat_queue.send('{}Quota for {} $FFFwin is {}'
+                                         .format(market.prefix, market.label(team), str(quotas[team])), player)
                 else:
-                    await self.instance.chat('$s$FFF//Bet$1EFMania$FFF: No current Quota for Team {}{} $FFFwin'
-                                             .format(self.team_colors[team], team), player)
+                    self.chat_queue.send('{}No current Quota for Team {} $FFFwin'
+                                         .format(market.prefix, market.label(team)), player)
 
         else:
-            await self.instance.chat('$s$FFF//Bet$1EFMania$FFF: We don\'t have an active bet at the moment.', player)
+            self.chat_queue.send('{}We don\'t have an active bet at the moment.'.format(market.prefix), player)
+
+    async def show_quota_history(self, player, data, **kwargs):
+        # Outputs the quota trend of each team of the running bet or, if there's none, of the last archived bet
+        market_id = getattr(data, 'market', None) or self.markets.default
+        market = self.markets.get(market_id)
+
+        if market is not None and market.bet_current and len(market.history):
+            history, winner = market.history, None
+        else:
+            history, winner = next(((history, winner) for archived_id, winner, history in reversed(self.quota_archive)
+                                    if archived_id == market_id), (None, None))
+
+        prefix = market.prefix if market else '$s$FFF//Bet$1EFMania$FFF: '
+
+        if history is None or not len(history):
+            self.chat_queue.send('{}No quota history available yet.'.format(prefix), player)
+            return
+
+        for team in history.teams:
+            quotas = [quota for quota in history.ordered(history.quotas[team]) if quota > 0]
+            label = market.label(team) if market else team
+
+            if quotas:
+                self.chat_queue.send(
+                    '{}{}{} $FFF$n{}$z$s $FFF{} → {} (min {}, max {})'
+                    .format(prefix, label, ' $FE1(winner)' if team == winner else '', sparkline(quotas), quotas[0],
+                            quotas[-1], min(quotas), max(quotas)), player)
+            else:
+                self.chat_queue.send('{}No quota for Team {} $FFFyet'.format(prefix, label), player)
 
     async def show_supporters(self, player, data, **kwargs):
-        if data.team in self.teams:
-            if self.stack[data.team] > 0:
-                view = SupportersListView(self, data.team)
+        market = await self.get_market(player, data)
+
+        if market is None:
+            return
+
+        if data.team in market.teams:
+            if market.pool.stack[data.team] > 0:
+                view = SupportersListView(self, market, data.team)
                 await view.display(player.login)
             else:
-                await self.instance.chat('$s$FFF//Bet$1EFMania$FFF: Team {}{} $FFFhas currently no supporters :('
-                                         .format(self.team_colors[data.team], data.team), player)
+                self.chat_queue.send('{}Team {} $FFFhas currently no supporters :('
+                                     .format(market.prefix, market.label(data.team)), player)
 
         else:
-            await self.instance.chat('$s$FFF//Bet$1EFMania$FFF: There\'s no $CCC{} $FFFteam.'.format(data.team), player)
+            self.chat_queue.send('{}There\'s no $CCC{} $FFFteam.'.format(market.prefix, data.team), player)
+
+    async def show_player_stats(self, player, data, **kwargs):
+        stats, rank = await self.stats.get(player.login)
+
+        if stats is None:
+            self.chat_queue.send('$s$FFF//Bet$1EFMania$FFF: You haven\'t taken part in a resolved bet yet.', player)
+            return
+
+        self.chat_queue.send(
+            '$s$FFF//Bet$1EFMania$FFF: Rank $1EF#{} $FFF// wagered $FE1{} $FFF// won $FE1{} $FFF// net {}{:+d} '
+            '$FFF// $1EF{} $FFFbets, win rate $1EF{:.0f}%'
+            .format(rank, stats.wagered, stats.won, '$1E1' if stats.profit >= 0 else '$E11', stats.profit,
+                    stats.bets, stats.wins / stats.bets * 100 if stats.bets else 0), player)
+
+    async def show_leaderboard(self, player, data, **kwargs):
+        view = BetLeaderboardView(self)
+        await view.display(player.login)
+
+    async def record_stats(self, market, winner, payouts, refunded=None):
+        # Adds a resolved bet to the stats of this server's supporters, leaving out stakes refunded as late
+        if await self.setting_bet_player_stats.get_value():
+            backers = market.pool.backers
+
+            if refunded:
+                backers = {login: (team, amount - refunded.get(login, 0)) for login, (team, amount) in backers.items()
+                           if amount > refunded.get(login, 0)}
+
+            with self.metrics.timer('stats_update'):
+                await self.stats.record(backers, winner, payouts)
+
+    async def show_markets(self, player, data, **kwargs):
+        # Outputs all markets with an active bet
+        markets = [market for market in self.markets if market.bet_current]
+
+        if not markets:
+            self.chat_queue.send('$s$FFF//Bet$1EFMania$FFF: We don\'t have an active bet at the moment.', player)
+
+        for market in markets:
+            self.chat_queue.send(
+                '$s$FFF//Bet$1EFMania$FFF: Market $1EF{} $FFF({}): {} // stake $FE1{} $FFFplanets'
+                .format(market.id, 'open' if market.bet_open else 'closed',
+                        '$FFF, '.join(market.label(team) for team in market.teams), int(market.pool.stake)), player)
+
+    async def get_market(self, player, data):
+        # Returns the market named by the command's optional market argument, or the default market
+        market_id = getattr(data, 'market', None)
+        market = self.markets.get(market_id)
+
+        if market is None and player is not None:
+            self.chat_queue.send('$s$FFF//Bet$1EFMania$FFF: There\'s no market $CCC{}$FFF.'.format(market_id),
+                                 player)
+
+        return market
 
     async def place_bet(self, player, data, **kwargs):
         # Checks first if bet is open. Allows player to bet planets via donating them (works the same way)
-        if self.bet_open:
-            if data.team in self.teams:
-                total_stake = data.amount
+        market = await self.get_market(player, data)
+
+        if market is None:
+            return
+
+        if market.bet_open:
+            if data.team in market.teams:
+                # The per-player lock serializes the checks and the SendBill round-trip of one player, bills of
+                # different players are sent concurrently
+                async with self.metrics.lock('player', self.player_locks(player.login)):
+                    if self.pending.count_of(player.login) >= self.admission.max_outstanding:
+                        self.metrics.inc('bets_rejected', reason='pending')
+                        self.chat_queue.send('{}{}'.format(market.prefix, ADMISSION_MESSAGES['pending']), player)
+                        return
+
+                    # Unpaid bills count towards the stake limits as if they were paid already
+                    total_stake = data.amount + self.pending.amount_of(market.bet_id, player.login)
+                    backed_team = market.pool.team_of(player.login)
+
+                    if backed_team == data.team:
+                        total_stake += market.pool.amount_of(player.login)
+
+                    if market.min_bet <= total_stake <= market.max_bet:
+                        # The backers index and the pending bills tell whether the player supports another team
+                        pending_team = self.pending.team_of(market.bet_id, player.login)
+                        bet_allowed = backed_team in (None, data.team) and pending_team in (None, data.team)
+
+                        if not bet_allowed:
+                            self.metrics.inc('bets_rejected', reason='team')
+                            self.chat_queue.send('{}You have already supported a team, thus you can\'t support a '
+                                                 'second one. Bet rejected.'.format(market.prefix), player)
+
+                        else:
+                            try:
+                                amount = abs(int(data.amount))
 
-                if player.login in self.supporters[data.team]:
-                    total_stake += self.supporters[data.team][player.login]
+                                # Tokens are only taken by bets which passed all other checks and are about to be sent,
+                                # so rejected or malformed bets don't use up the player's or the global rate
+                                rejection = self.admission.admit(player.login)
 
-                if self.min_bet <= total_stake <= self.max_bet:
-                    bet_allowed = True
+                                if rejection:
+                                    self.metrics.inc('bets_rejected', reason=rejection)
+                                    self.chat_queue.send('{}{}'.format(market.prefix,
+                                                                       ADMISSION_MESSAGES[rejection]), player)
+                                    return
 
-                    for team in self.teams:
-                        if team == data.team:
-                            continue
+                                with self.metrics.timer('gbx_call', method='SendBill'):
+                                    bill_id = await self.instance.gbx('SendBill', player.login, amount,
+                                                                      'BetMania: Betting {} planets on team {}!'
+                                                                      .format(amount, data.team), '')
 
-                        if player.login in self.supporters[team]:
-                            bet_allowed = False
-                            await self.instance.chat('$s$FFF//Bet$1EFMania$FFF: You have already supported a team, '
-                                                     'thus you can\'t support a second one. Bet rejected.', player)
-                            break
+                                self.recorder.gbx('SendBill', (player.login, amount), bill_id)
 
-                    if bet_allowed:
-                        try:
-                            async with self.lock:
-                                amount = abs(int(data.amount))
-                                bill_id = await self.instance.gbx('SendBill', player.login, amount,
-                                                                  'BetMania: Betting {} planets on team {}!'
-                                                                  .format(amount, data.team), '')
-                                self.bets[bill_id] = dict(player=player, amount=amount, team=data.team)
+                                self.nicknames.put(player.login, player.nickname)
 
-                        except ValueError:
-                            await self.instance.chat('$i$f00The amount should be a numeric value.', player)
+                                async with self.metrics.lock('state', self.state_lock):
+                                    self.pending.add(bill_id, dict(market=market.id, bet_id=market.bet_id,
+                                                                   login=player.login, nickname=player.nickname,
+                                                                   amount=amount, team=data.team))
+                                    self.record('bill_sent', bill_id=bill_id, market=market.id, bet_id=market.bet_id,
+                                                login=player.login, nickname=player.nickname, amount=amount,
+                                                team=data.team)
 
-                else:
-                    await self.instance.chat(
-                        '$s$FFF//Bet$1EFMania$FFF: Your stake ($CCC{}$FFF) does not match the stake limits. Use an '
-                        'amount between $1EF{} $FFFand $1EF{} $FFFplanets please.'
-                        .format(total_stake, self.min_bet, self.max_bet), player)
+                            except ValueError:
+                                self.chat_queue.send('$i$f00The amount should be a numeric value.', player)
+
+                    else:
+                        self.metrics.inc('bets_rejected', reason='stake')
+                        self.chat_queue.send(
+                            '{}Your stake ($CCC{}$FFF) does not match the stake limits. Use an amount between $1EF{} '
+                            '$FFFand $1EF{} $FFFplanets please.'
+                            .format(market.prefix, total_stake, market.min_bet, market.max_bet), player)
 
             else:
-                await self.instance.chat(
-                    '$s$FFF//Bet$1EFMania$FFF: Please specify the team you want to place your bet on. Allowed '
-                    'arguments are $1EF{}'.format('$FFF, $1EF'.join(self.teams)), player)
+                self.chat_queue.send(
+                    '{}Please specify the team you want to place your bet on. Allowed arguments are $1EF{}'
+                    .format(market.prefix, '$FFF, $1EF'.join(market.teams)), player)
         else:
-            await self.instance.chat(
-                '$s$FFF//Bet$1EFMania$FFF: There\'s no open bet at the moment. Please try again later (or ask an '
-                'ServerOp to open one ;)',
-                player)
+            self.chat_queue.send(
+                '{}There\'s no open bet at the moment. Please try again later (or ask an ServerOp to open one ;)'
+                .format(market.prefix), player)
 
     async def receive_bet(self, bill_id, state, state_name, transaction_id, **kwargs):
         # Callback method when bill_updated signal is received. Ensures that the BetMania vars are only updated if a payment has occured
-        if bill_id in self.bets:
-            async with self.lock:
-                if state == 4:
-                    await self.instance.chat(
-                        '$s$FFF//Bet$1EFMania$FFF: {} $FFFhas placed a bet of $s$FE1{} $FFFplanets on team {}{}.'
-                        .format(self.bets[bill_id]['player'].nickname, str(self.bets[bill_id]['amount']),
-                                self.team_colors[self.bets[bill_id]['team']], self.bets[bill_id]['team']))
-
-                    self.stack[self.bets[bill_id]['team']] += self.bets[bill_id]['amount']
-                    self.stake = await self.calc_stake()
-
-                    if self.bets[bill_id]['player'].login in self.supporters[self.bets[bill_id]['team']]:
-                        self.supporters[self.bets[bill_id]['team']][self.bets[bill_id]['player'].login] += self.bets[bill_id]['amount']
-                    else:
-                        self.supporters[self.bets[bill_id]['team']][self.bets[bill_id]['player'].login] = self.bets[bill_id]['amount']
+        if bill_id in self.pending and state >= 4:
+            async with self.metrics.lock('state', self.state_lock):
+                self.settle_bill(bill_id, state)
+
+    async def player_info_changed(self, *args, **kwargs):
+        # Drops the cached nickname, so the next supporters list shows the player's current one
+        login = kwargs.get('player_login') or getattr(kwargs.get('player'), 'login', None)
+
+        if login:
+            self.nicknames.invalidate(login)
+
+    def settle_bill(self, bill_id, state):
+        # Credits a paid bill (state 4) or drops a refused one (state > 4). Returns False for unknown bills.
+        bet = self.pending.pop(bill_id)
+
+        if bet is None:
+            return False
+
+        self.metrics.inc('bills', state='paid' if state == 4 else 'refused')
+        market = self.markets.get(bet['market'])
 
-                    del self.bets[bill_id]
+        if state == 4 and (market is None or not market.bet_current or bet.get('bet_id') != market.bet_id):
+            # The bet has been resolved or reset before the bill was paid, so the stake goes back to the player. This
+            # includes bills of an earlier bet of a market which has been opened again since.
+            # The refund is queued right away, so the ledger never holds the confirmation without it
+            self.record('bill_confirmed', bill_id=bill_id)
+            self.outbox.enqueue('refund', [(bet['login'], bet['amount'])], 'Bet payback from the server')
 
-                elif state > 4:
-                    await self.instance.chat(
-                        '$s$FFF//Bet$1EFMania$FFF: Transaction refused or failed! No bet was placed!',
-                        self.bets[bill_id]['player'])
-                    del self.bets[bill_id]
+        elif state == 4:
+            self.metrics.observe('bill_confirm', time.time() - bet['sent'])
+            market.pool.add(bet['team'], bet['login'], bet['amount'])
+
+            if self.shared_pool:
+                self.shared_pool.add(market, bet['team'], bet['login'], bet['amount'])
+
+            self.record('bill_confirmed', bill_id=bill_id)
+            self.chat_queue.announce_bet(bet['nickname'], bet['amount'], market.label(bet['team']))
+
+        else:
+            self.record('bill_refused', bill_id=bill_id)
+            self.chat_queue.send('$s$FFF//Bet$1EFMania$FFF: Transaction refused or failed! No bet was placed!',
+                                 bet['login'])
+
+        return True
+
+    async def reconcile_bills(self):
+        # Periodically checks bills past their timeout against the server and either credits or drops them
+        while True:
+            await asyncio.sleep(max(1, self.pending.timeout / 4))
+
+            expired = deque(self.pending.pop_expired())
+
+            try:
+                await self.reconcile_expired(expired)
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                # The bills left are checked again after another timeout
+                logger.exception('Could not reconcile pending bills')
+
+                for bill_id in expired:
+                    self.pending.rearm(bill_id)
+
+    async def reconcile_expired(self, expired):
+        # Checks the expired bills in batches, the deque only keeps the bills which haven't been handled yet
+        while expired:
+            batch = [expired[i] for i in range(min(50, len(expired)))]
+
+            try:
+                with self.metrics.timer('gbx_call', method='GetBillState'):
+                    results = await self.instance.gbx.multicall(
+                        *[self.instance.gbx.prepare('GetBillState', bill_id) for bill_id in batch])
+            except Exception as e:
+                logger.warning('Could not reconcile pending bills: {}'.format(e))
+                results = [None] * len(batch)
+
+            for bill_id, result in zip(batch, results):
+                self.recorder.gbx('GetBillState', (bill_id,), result)
+
+            async with self.metrics.lock('state', self.state_lock):
+                for bill_id, result in zip(batch, results):
+                    bet = self.pending.get(bill_id)
+                    expired.popleft()
+
+                    if bet is None:
+                        continue
+
+                    state = result.get('State', 0) if isinstance(result, dict) else 0
+
+                    if state >= 4:
+                        self.settle_bill(bill_id, state)
+                        self.pending.reconciled += 1
+                    elif time.time() - bet['sent'] > self.pending.timeout * 10:
+                        # Bills which are still unpaid after ten timeouts are considered abandoned
+                        self.settle_bill(bill_id, 6)
+                        self.pending.dropped += 1
+                    else:
+                        self.pending.rearm(bill_id)
 
     async def betmania_info(self, player, data, **kwargs):
-        await self.instance.chat('$s$FFF//Bet$1EFMania $FFFBetting System v$FF00.3.3-4', player)
+        self.chat_queue.send('$s$FFF//Bet$1EFMania $FFFBetting System v$FF00.3.3-4', player)
 
-        await self.instance.chat('$s$1EF/bet <amount> <team>$FFF: $iBets an individual amount of planets on a team.',
-                                 player)
-        await self.instance.chat('$s$1EF/quota$FFF: $iShows the current payout quotas for each possible result.',
-                                 player)
-        await self.instance.chat('$s$1EF/supporters <team>$FFF: $iShows a list of all current supporters of the '
-                                 'specified team.', player)
+        self.chat_queue.send('$s$1EF/bet <amount> <team> [market]$FFF: $iBets an individual amount of planets on '
+                             'a team.', player)
+        self.chat_queue.send('$s$1EF/quota [market]$FFF: $iShows the current payout quotas for each possible '
+                             'result.', player)
+        self.chat_queue.send('$s$1EF/supporters <team> [market]$FFF: $iShows a list of all current supporters of '
+                             'the specified team.', player)
+        self.chat_queue.send('$s$1EF/markets$FFF: $iLists all markets with an active bet.', player)
 
         if player.level > 0:
-            await self.instance.chat('$s$1EF//openbet$FFF: $iOpens up a new bet or reopens a closed one.', player)
-            await self.instance.chat('$s$1EF//closebet$FFF: $iCloses an existing bet for new entries.', player)
+            self.chat_queue.send('$s$1EF//openbet [market] [teams]$FFF: $iOpens up a new bet or reopens a closed '
+                                 'one.', player)
+            self.chat_queue.send('$s$1EF//closebet$FFF: $iCloses an existing bet for new entries.', player)
 
         if player.level == 3:
-            await self.instance.chat('$s$1EF//resolvebet$FFF: $iCloses and resolves an open bet.', player)
-            await self.instance.chat('$s$1EF//resetbet$FFF: $iResets an open bet. Players get their payins refunded.',
-                                     player)
+            self.chat_queue.send('$s$1EF//resolvebet$FFF: $iCloses and resolves an open bet.', player)
+            self.chat_queue.send('$s$1EF//resetbet$FFF: $iResets an open bet. Players get their payins refunded.',
+                                 player)
 
     async def reconfigure_teams(self, *args, **kwargs):
-        if not self.bet_current:
-            team_config = await self.setting_bet_config_teams.get_value()
-            self.teams = team_config.split(',')
+        # Updates the configured teams used for new markets. The default market picks them up unless it has a bet.
+        team_config = await self.setting_bet_config_teams.get_value()
+        self.teams = team_config.split(',')
 
-            color_config = await self.setting_bet_config_team_colors.get_value()
-            colors = color_config.split(',')
+        color_config = await self.setting_bet_config_team_colors.get_value()
+        colors = color_config.split(',')
 
-            iteration = 0
+        iteration = 0
 
-            for team in self.teams:
-                if iteration < len(colors):
-                    self.team_colors[team] = colors[iteration]
-                else:
-                    self.team_colors[team] = '$s$DDD'
+        for team in self.teams:
+            if iteration < len(colors):
+                self.team_colors[team] = colors[iteration]
+            else:
+                self.team_colors[team] = '$s$DDD'
 
-                self.supporters[team] = dict()
-                self.stack[team] = 0
-                iteration += 1
+            iteration += 1
+
+        market = self.markets.get()
+
+        if not market.bet_current:
+            market.configure_teams(self.teams, self.team_colors)
 
     async def toggle_widget(self, *args, **kwargs):
-        await self.instance.chat('$s$FFF//Bet$1EFMania$FFF: UI will be added in a future version.')
+        if not self.widget:
+            return
 
-    async def calc_stake(self):
-        stake = 0
+        if await self.setting_show_widget.get_value():
+            self.widget.start()
+        elif self.widget.task:
+            self.widget.stop()
+            await self.widget.hide()
 
-        for team in self.teams:
-            stake += self.stack[team]
+    async def player_connect(self, player, *args, **kwargs):
+        # Newly connected players receive the current widget right away instead of waiting for the next change
+        if self.widget and self.widget.task:
+            await self.widget.display(player_logins=[player.login])
 
-        deduct_amount = await self.setting_bet_margin.get_value()
-        deduct_rel = await self.setting_bet_margin_relative.get_value()
+    async def on_stop(self):
+        self.chat_queue.stop()
+        self.outbox.stop()
 
-        if deduct_rel:
-            if abs(deduct_amount) > 100:
-                deduct_amount %= 100
+        if self.widget:
+            self.widget.stop()
 
-            stake -= abs(deduct_amount) * (stake / 100)
-        else:
-            stake -= abs(deduct_amount)
+        if self.reconcile_task:
+            self.reconcile_task.cancel()
+
+        if self.metrics_task:
+            self.metrics_task.cancel()
+
+        if self.history_task:
+            self.history_task.cancel()
+
+        if self.shared_pool:
+            await self.shared_pool.stop()
+
+        await self.recorder.close()
+
+        if self.ledger:
+            await self.ledger.close()
+
+    async def open_ledger(self):
+        # Opens the bet ledger and restores an unresolved bet from its latest snapshot and the events written after it
+        path = await self.setting_bet_ledger_file.get_value()
 
-        return stake
+        if not path:
+            return
+
+        self.ledger = BetLedger(path, self.ledger_state)
+        await self.ledger.open()
+
+        started = time.monotonic()
+        state, events = await self.ledger.load()
+        state = self.ledger.replay(state, events)
+
+        for market_id, market_state in state['markets'].items():
+            market = self.markets.get(market_id) or self.markets.add(
+                Market(market_id, market_state['teams'], self.team_colors, self.bet_margin, self.bet_margin_relative))
+            market.configure_teams(market_state['teams'], self.team_colors)
+            market.bet_open = market_state['bet_open']
+            market.bet_current = True
+            market.min_bet = market_state['min_bet']
+            market.max_bet = market_state['max_bet']
+            market.bet_id = market_state.get('bet_id')
+            market.cycle = market_state.get('cycle')
+            self.restored_pushes[market.id] = market_state.get('pushed', dict())
+
+            for team, supporters in market_state['supporters'].items():
+                for login, amount in supporters.items():
+                    market.pool.add(team, login, amount)
+
+        # Bills of finished bets stay pending as well, they're refunded if they get paid
+        for bill_id, bet in state['bets'].items():
+            self.pending.add(bill_id, bet)
+
+        self.outbox.restore(state['outbox'])
+
+        if state['markets']:
+            logger.info('Restored {} unresolved bets from the ledger ({} events replayed in {:.1f}ms)'
+                        .format(len(state['markets']), len(events), (time.monotonic() - started) * 1000))
+
+    async def open_shared_pool(self):
+        # Connects to the pool shared with other servers and keeps syncing the markets restored from the ledger
+        path = await self.setting_bet_shared_pool_file.get_value()
+
+        if not path:
+            return
+
+        node = await self.setting_bet_shared_pool_node.get_value() or self.instance.game.server_player_login
+        self.shared_pool = SharedPool(self, SqlitePoolBackend(path), node)
+        await self.shared_pool.start()
+
+        for market in self.markets:
+            if market.bet_current and market.cycle is not None:
+                self.shared_pool.restore(market, self.restored_pushes.get(market.id, dict()))
+
+    async def open_trace(self, *args, **kwargs):
+        # Starts, stops or switches the trace recording whenever the trace file setting changes
+        path = await self.setting_bet_trace_file.get_value()
+
+        if path == self.recorder.path:
+            return
+
+        await self.recorder.close()
+
+        if path:
+            # The header holds the settings affecting the betting, so a replay runs with the same configuration
+            settings = (self.setting_bet_config_teams, self.setting_bet_config_team_colors, self.setting_bet_margin,
+                        self.setting_bet_margin_relative, self.setting_bet_minimum_stake,
+                        self.setting_bet_maximum_stake, self.setting_bet_admission_player_rate,
+                        self.setting_bet_admission_global_rate, self.setting_bet_max_pending_bills,
+                        self.setting_bet_chat_rate, self.setting_bet_chat_summary_interval,
+                        self.setting_bet_auto_mode, self.setting_bet_auto_close_after, self.setting_bet_bill_timeout)
+
+            await self.recorder.open(path, dict(settings={setting.key: await setting.get_value()
+                                                          for setting in settings}))
+
+    def ledger_state(self):
+        markets = {market.id: market.state() for market in self.markets if market.bet_current}
+
+        if self.shared_pool:
+            for market_state in markets.values():
+                market_state['pushed'] = self.shared_pool.pushed.get(market_state['cycle'], dict())
+
+        return dict(markets=markets, bets=self.pending.bills, outbox=self.outbox.state())
+
+    def record(self, event, **data):
+        if self.ledger:
+            self.ledger.append(event, **data)
+
+    async def refresh_settings(self, *args, **kwargs):
+        # Caches the margin and stake limit settings. Called on start and whenever one of these settings changes.
+        self.bet_margin = await self.setting_bet_margin.get_value()
+        self.bet_margin_relative = await self.setting_bet_margin_relative.get_value()
+        self.bet_minimum_stake = await self.setting_bet_minimum_stake.get_value()
+        self.bet_maximum_stake = await self.setting_bet_maximum_stake.get_value()
+
+        for market in self.markets:
+            market.pool.configure(self.bet_margin, self.bet_margin_relative)
+
+        self.autobet.configure(await self.setting_bet_auto_mode.get_value(),
+                               await self.setting_bet_auto_close_after.get_value())
+        self.pending.timeout = max(1, await self.setting_bet_bill_timeout.get_value())
+        self.admission.configure(await self.setting_bet_admission_player_rate.get_value(), 3,
+                                 await self.setting_bet_admission_global_rate.get_value(),
+                                 await self.setting_bet_max_pending_bills.get_value())
+        self.chat_queue.configure(await self.setting_bet_chat_rate.get_value(),
+                                  await self.setting_bet_chat_summary_interval.get_value())
+
+    async def show_stats(self, player, data, **kwargs):
+        # Outputs the collected timings and counters of the hot paths
+        for (name, labels) in sorted(self.metrics.timings):
+            summary = self.metrics.summary((name, labels))
+            self.chat_queue.send(
+                '$FFF{} {}: $1EF{} $FFFcalls // avg $1EF{:.1f}ms $FFF// p50 $1EF{:.1f}ms $FFF// p99 $1EF{:.1f}ms '
+                '$FFF// max $1EF{:.1f}ms'
+                .format(name, ' '.join(value for _, value in labels), summary['count'], summary['avg'] * 1000,
+                        summary['p50'] * 1000, summary['p99'] * 1000, summary['max'] * 1000), player)
+
+        self.chat_queue.send(
+            '$FFFChat: $1EF{:.2f} $FFFmessages/s // $1EF{} $FFFsent // $1EF{} $FFFqueued'
+            .format(self.metrics.rate('chat_messages'), self.chat_queue.sent, len(self.chat_queue)), player)
+        self.chat_queue.send(
+            '$FFFBills: $1EF{} $FFFpaid // $1EF{} $FFFrefused // $1EF{} $FFFpending'
+            .format(self.metrics.counters[('bills', (('state', 'paid'),))],
+                    self.metrics.counters[('bills', (('state', 'refused'),))], len(self.pending)), player)
+        self.chat_queue.send(
+            '$FFFRejected bets: $1EF{} $FFFtoo fast // $1EF{} $FFFserver busy // $1EF{} $FFFunpaid bills // $1EF{} '
+            '$FFFstake limits // $1EF{} $FFFsecond team'
+            .format(*[self.metrics.counters[('bets_rejected', (('reason', reason),))]
+                      for reason in ('player_rate', 'global_rate', 'pending', 'stake', 'team')]), player)
+        self.chat_queue.send(
+            '$FFFPayout outbox: $1EF{} $FFFqueued ($FE1{} $FFFplanets) // oldest $1EF{:.1f}s $FFF// $1EF{} $FFFwaiting '
+            'for server planets // $1EF{} $FFFretries // $1EF{} $FFFgiven up'
+            .format(len(self.outbox), self.outbox.amount, self.outbox.age, self.outbox.deferred, self.outbox.retries,
+                    self.outbox.given_up), player)
+
+    async def sample_quotas(self):
+        # Samples the quotas and stakes of all running bets into their history every 5 seconds
+        while True:
+            await asyncio.sleep(5)
+
+            for market in self.markets:
+                if market.bet_current:
+                    market.history.sample(market.pool)
+
+    def archive_history(self, market, winner):
+        # Keeps a downsampled copy of the finished bet's history, the full ring buffer is dropped with the next bet
+        market.history.sample(market.pool)
+        self.quota_archive.append((market.id, winner, market.history.downsample(48)))
+
+    async def write_metrics(self):
+        # Writes the metrics to the configured file in the Prometheus text format
+        while True:
+            await asyncio.sleep(15)
+            path = await self.setting_bet_metrics_file.get_value()
+
+            if not path:
+                continue
+
+            self.metrics.gauges.update(pending_bills=len(self.pending), chat_queue=len(self.chat_queue),
+                                       outbox=len(self.outbox), outbox_age=self.outbox.age,
+                                       outbox_deferred=self.outbox.deferred,
+                                       markets=len(self.markets),
+                                       stake=sum(market.pool.total for market in self.markets),
+                                       supporters=sum(len(market.pool.backers) for market in self.markets))
+
+            try:
+                await asyncio.get_event_loop().run_in_executor(None, self.metrics.write, path)
+            except OSError as e:
+                logger.warning('Could not write metrics to {}: {}'.format(path, e))
+
+    async def report_payouts(self, report, player, kind):
+        # Sends a short summary of a finished payout batch to the admin who triggered it
+        if player is None:
+            # Payouts triggered by the Auto-Bet mode have no admin to report to
+            for login, amount, reason in report.failed:
+                logger.warning('Payout of {} planets to {} failed: {}'.format(amount, login, reason))
+
+            return
+
+        self.chat_queue.send(
+            '$s$FFF//Bet$1EFMania$FFF: Paid $FE1{} $FFFplanets to $1EF{} $FFFplayers in {:.2f}s.'
+            .format(report.total, len(report.succeeded), report.duration), player)
+
+        if report.failed:
+            self.chat_queue.send(
+                '$s$FFF//Bet$1EFMania$FFF: $F00{} payouts failed: $FFF{}'
+                .format(len(report.failed), ', '.join('{} ({})'.format(login, amount)
+                                                      for login, amount, _ in report.failed)), player)
 
     async def debug(self, player, data, **kwargs):
-        await self.instance.chat(
-            '$FFFbet_open: $000{} $FFF// bet_current: $000{} $FFF// stack_red: $F00{} $FFF// stack_blue: $00F{} $FFF//'
-            ' stake: $000{}'
-            .format(str(self.bet_open), str(self.bet_current), str(self.stack['red']), str(self.stack['blue']),
-                    str(self.stake)),
-            player)
-        await self.instance.chat('$FFFEntries in supporters_red: $F00{} $FFF// Entries in supporters_blue: $00F{}'
-                                 .format(str(len(self.supporters['red'])), str(len(self.supporters['blue']))), player)
-        await self.instance.chat('$FFFEntries in supporters_red: $F00{}'.format(str(self.supporters['red'])), player)
-        await self.instance.chat('$FFFTeams: $F00{}'.format(str(self.teams)), player)
+        for market in self.markets:
+            self.chat_queue.send(
+                '$FFFMarket $1EF{} $FFF// bet_open: $1EF{} $FFF// bet_current: $1EF{} $FFF// total: $FE1{} $FFF// '
+                'stake: $FE1{}'.format(market.id, str(market.bet_open), str(market.bet_current),
+                                       str(market.pool.total), str(market.pool.stake)), player)
+
+            for team in market.teams:
+                self.chat_queue.send('$FFFTeam {}$FFF: stack $FE1{} $FFF// supporters $1EF{}'
+                                     .format(market.label(team), market.pool.stack.get(team, 0),
+                                             len(market.pool.supporters.get(team, ()))), player)
+
+        self.chat_queue.send('$FFFPending bills: $1EF{} $FFF// expired: $1EF{} $FFF// reconciled: $1EF{} $FFF// '
+                             'dropped: $1EF{}'.format(len(self.pending), self.pending.expired,
+                                                      self.pending.reconciled, self.pending.dropped), player)
+
+        for login, amount, key in self.outbox.uncertain:
+            self.chat_queue.send('$FFFUnconfirmed payout $1EF{} $FFFof $FE1{} $FFFplanets to $1EF{}$FFF, please '
+                                 'check manually'.format(key, amount, login), player)
+
+        for timings in list(self.autobet.timings)[-3:]:
+            self.chat_queue.send(
+                '$FFFAuto-Bet cycle $1EF{}$FFF: open $1EF{:.0f}ms $FFF// betting $1EF{:.1f}s $FFF// close $1EF{:.0f}ms '
+                '$FFF// wait for result $1EF{:.1f}s $FFF// resolve $1EF{:.0f}ms $FFF// winner $1EF{}'
+                .format(timings['cycle'], timings['open'] * 1000, timings.get('betting', 0),
+                        timings.get('close', 0) * 1000, timings.get('wait', 0), timings['resolve'] * 1000,
+                        timings['winner']), player)
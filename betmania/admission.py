@@ -0,0 +1,71 @@
+import time
+
+
+class TokenBucket:
+    __slots__ = ('rate', 'burst', 'tokens', 'updated')
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+
+    def take(self, now):
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+        if self.tokens < 1:
+            return False
+
+        self.tokens -= 1
+        return True
+
+
+class Admission:
+    """
+    Admission control of /bet, applied before any GBX call is made. Each player has a token bucket limiting how fast
+    they can bet, a global bucket limits the bills sent over all players. Buckets of idle players are dropped lazily.
+    """
+
+    def __init__(self, player_rate=12, player_burst=3, global_rate=50, max_outstanding=2, max_players=10000):
+        self.players = dict()
+        self.max_players = max_players
+        self.configure(player_rate, player_burst, global_rate, max_outstanding)
+
+    def configure(self, player_rate, player_burst, global_rate, max_outstanding):
+        # The player rate is given in bets per minute, the global rate in bills per second
+        self.player_rate = max(1, player_rate) / 60
+        self.player_burst = max(1, player_burst)
+        self.global_bucket = TokenBucket(max(1, global_rate), max(1, global_rate) * 2)
+        self.max_outstanding = max(1, max_outstanding)
+        self.players = dict()
+
+    def admit(self, login):
+        """
+        Takes a token of the player's and of the global bucket.
+
+        :return: None if the bet is admitted, otherwise the reason of the rejection ('player_rate' or 'global_rate').
+        """
+        now = time.monotonic()
+        bucket = self.players.get(login)
+
+        if bucket is None:
+            if len(self.players) >= self.max_players:
+                self.prune(now)
+
+            bucket = self.players[login] = TokenBucket(self.player_rate, self.player_burst)
+
+        if not bucket.take(now):
+            return 'player_rate'
+
+        if not self.global_bucket.take(now):
+            # The player's token is given back, the bet was rejected for reasons the player can't influence
+            bucket.tokens += 1
+            return 'global_rate'
+
+        return None
+
+    def prune(self, now):
+        # Drops the buckets which have been refilled completely, these players are treated like new ones anyway
+        idle = self.player_burst / self.player_rate
+        self.players = {login: bucket for login, bucket in self.players.items() if now - bucket.updated < idle}
@@ -0,0 +1,130 @@
+import asyncio
+import logging
+import time
+
+from argparse import Namespace
+from collections import deque
+
+logger = logging.getLogger(__name__)
+
+
+class AutoBet:
+    """
+    Runs a betting cycle per round without any admin commands: a bet is opened at round start, closed after a
+    configurable amount of seconds and resolved with the result of the round. Auto-Bet always uses the default market.
+    In modes without teams, each playing player is an outcome of the bet, using the player logins as teams.
+    """
+
+    def __init__(self, app):
+        self.app = app
+        self.enabled = False
+        self.close_after = 30
+
+        self.cycle = 0
+        self.use_teams = None
+        self.current = None
+        self.close_task = None
+        self.timings = deque(maxlen=20)
+
+    def configure(self, enabled, close_after):
+        self.enabled = enabled
+        self.close_after = max(1, close_after)
+
+    async def round_start(self, *args, **kwargs):
+        if not self.enabled:
+            return
+
+        # A bet of the previous round which didn't receive a result is cancelled before the next cycle starts. Bets
+        # opened manually by an admin are left alone.
+        if self.app.markets.get().bet_current:
+            if not self.owns(self.current):
+                return
+
+            await self.finish(None)
+
+        use_teams = await self.is_team_mode()
+        teams = None
+
+        if not use_teams:
+            teams = sorted(player.login for player in self.app.instance.player_manager.online
+                           if not player.flow.is_spectator)
+
+            if len(teams) < 2:
+                logger.info('Auto-Bet skips a round with {} players, a bet needs at least two outcomes'
+                            .format(len(teams)))
+                return
+
+        self.cycle += 1
+        started = time.monotonic()
+        await self.app.open_bet(None, Namespace(teams=','.join(teams)) if teams else None)
+
+        self.current = dict(cycle=self.cycle, bet_id=self.app.markets.get().bet_id, opened=started,
+                            open=time.monotonic() - started)
+        self.close_task = asyncio.ensure_future(self.close_later(self.cycle))
+
+    def owns(self, current):
+        # Whether the bet of the default market is still the one opened by the cycle, an admin may have resolved it and
+        # opened another bet since
+        market = self.app.markets.get()
+        return current is not None and market.bet_current and market.bet_id == current['bet_id']
+
+    async def is_team_mode(self):
+        # Known from the last round's scores, otherwise guessed from the name of the mode script
+        if self.use_teams is None:
+            script = await self.app.instance.mode_manager.get_current_script()
+            return 'team' in script.lower()
+
+        return self.use_teams
+
+    async def close_later(self, cycle):
+        await asyncio.sleep(self.close_after)
+
+        if self.owns(self.current) and self.current['cycle'] == cycle and self.app.markets.get().bet_open:
+            started = time.monotonic()
+            await self.app.close_bet(None, None)
+            self.current.update(betting=started - self.current['opened'], close=time.monotonic() - started,
+                                closed=time.monotonic())
+
+    async def scores(self, section, players=None, teams=None, winner_team=None, use_teams=False, winner_player=None,
+                     **kwargs):
+        if section != 'EndRound':
+            return
+
+        self.use_teams = bool(use_teams)
+
+        if not self.current:
+            return
+
+        winner = None
+        teams = self.app.markets.get().teams
+
+        if use_teams and winner_team is not None and 0 <= winner_team < len(teams):
+            winner = teams[winner_team]
+        elif winner_player:
+            # The players of the round are the teams in modes without teams
+            login = getattr(winner_player, 'login', winner_player)
+            winner = login if login in teams else None
+
+        await self.finish(winner)
+
+    async def finish(self, winner):
+        if self.close_task:
+            self.close_task.cancel()
+            self.close_task = None
+
+        current, self.current = self.current, None
+        started = time.monotonic()
+
+        if not self.owns(current):
+            return
+
+        if 'closed' in current:
+            current['wait'] = started - current['closed']
+
+        if winner:
+            await self.app.resolve_bet(None, Namespace(team=winner))
+        else:
+            await self.app.reset_bet(None, None)
+
+        current.update(resolve=time.monotonic() - started, winner=winner)
+        self.timings.append(current)
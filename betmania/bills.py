@@ -0,0 +1,93 @@
+import heapq
+import time
+
+from collections import Counter
+
+
+class PendingBills:
+    """
+    Index of all bills sent to players which haven't been paid or refused yet. Every bill gets a deadline, bills past
+    their deadline are handed out for reconciliation with the server. Entries of removed bills are dropped lazily from
+    the deadline heap.
+    """
+
+    def __init__(self, timeout=120):
+        self.timeout = timeout
+
+        self.bills = dict()
+        self.deadlines = list()
+        self.logins = dict()
+        self.counts = Counter()
+
+        self.expired = 0
+        self.reconciled = 0
+        self.dropped = 0
+
+    def __contains__(self, bill_id):
+        return bill_id in self.bills
+
+    def __len__(self):
+        return len(self.bills)
+
+    def get(self, bill_id):
+        return self.bills.get(bill_id)
+
+    def add(self, bill_id, bet):
+        bet.setdefault('sent', time.time())
+        self.bills[bill_id] = bet
+        heapq.heappush(self.deadlines, (time.monotonic() + self.timeout, bill_id))
+
+        key = (bet.get('bet_id'), bet['login'])
+        team, count, amount = self.logins.get(key, (bet['team'], 0, 0))
+        self.logins[key] = (team, count + 1, amount + bet['amount'])
+        self.counts[bet['login']] += 1
+
+    def pop(self, bill_id):
+        bet = self.bills.pop(bill_id, None)
+
+        if bet is not None:
+            key = (bet.get('bet_id'), bet['login'])
+            team, count, amount = self.logins.pop(key)
+
+            if count > 1:
+                self.logins[key] = (team, count - 1, amount - bet['amount'])
+
+            self.counts[bet['login']] -= 1
+
+            if not self.counts[bet['login']]:
+                del self.counts[bet['login']]
+
+        return bet
+
+    def team_of(self, bet_id, login):
+        # Returns the team of the player's pending bills in a bet or None if the player has no pending bills there
+        return self.logins.get((bet_id, login), (None, 0, 0))[0]
+
+    def amount_of(self, bet_id, login):
+        # Returns the total amount of the player's pending bills in a bet
+        return self.logins.get((bet_id, login), (None, 0, 0))[2]
+
+    def count_of(self, login):
+        # Returns the number of pending bills of a player over all markets
+        return self.counts.get(login, 0)
+
+    def rearm(self, bill_id):
+        if bill_id in self.bills:
+            heapq.heappush(self.deadlines, (time.monotonic() + self.timeout, bill_id))
+
+    def pop_expired(self):
+        """
+        Returns the ids of all pending bills past their deadline. The bills stay in the index until they're either
+        popped or rearmed.
+        """
+        now = time.monotonic()
+        expired = list()
+
+        while self.deadlines and self.deadlines[0][0] <= now:
+            _, bill_id = heapq.heappop(self.deadlines)
+
+            if bill_id in self.bills:
+                expired.append(bill_id)
+
+        self.expired += len(expired)
+        return expired
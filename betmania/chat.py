@@ -0,0 +1,148 @@
+import asyncio
+import logging
+import time
+
+from collections import OrderedDict, deque
+
+logger = logging.getLogger(__name__)
+
+
+class ChatQueue:
+    """
+    Outbound chat pipeline of the app, all chat messages of the app go through it. Queued messages are grouped by
+    recipient and sent as GBX multicalls within a configurable messages-per-second budget. Bet announcements are merged
+    into periodic summaries. Private notices, like the payout notice of each winner, are only sent once no other
+    message is waiting, so announcements and command replies don't queue up behind them.
+    """
+
+    def __init__(self, app, rate=10, summary_interval=2, flush_interval=0.1):
+        self.app = app
+        self.rate = rate
+        self.summary_interval = summary_interval
+        self.flush_interval = flush_interval
+
+        self.queue = deque()
+        self.notices = deque()
+        self.announcements = list()
+        self.tokens = rate
+        self.last_refill = time.monotonic()
+        self.last_summary = time.monotonic()
+        self.sent = 0
+        self.task = None
+
+    def start(self):
+        self.task = asyncio.ensure_future(self.run())
+
+    def stop(self):
+        if self.task:
+            self.task.cancel()
+            self.task = None
+
+    def configure(self, rate, summary_interval):
+        self.rate = max(1, rate)
+        self.summary_interval = max(0, summary_interval)
+
+    def __len__(self):
+        return len(self.queue) + len(self.notices)
+
+    @staticmethod
+    def recipients(logins):
+        # Logins may be passed as login strings or player objects. Returns None if only missing players were given,
+        # e.g. the admin of an Auto-Bet command, as the message would be sent to everyone otherwise.
+        recipients = tuple(getattr(login, 'login', login) for login in logins if login is not None)
+        return recipients if recipients or not logins else None
+
+    def send(self, message, *logins):
+        # Queues a global message or a reply to the given players
+        recipients = self.recipients(logins)
+
+        if recipients is not None:
+            self.queue.append((message, recipients))
+
+    def notify(self, message, *logins):
+        # Queues a private notice, which is sent after all other queued messages
+        recipients = self.recipients(logins)
+
+        if recipients:
+            self.notices.append((message, recipients))
+
+    def announce_bet(self, nickname, amount, label):
+        # The label names the team (and market) the bet was placed on
+        self.announcements.append((nickname, amount, label))
+
+    def flush_announcements(self):
+        # Queues the summary of all bet announcements collected so far
+        if not self.announcements:
+            return
+
+        if len(self.announcements) == 1:
+            nickname, amount, label = self.announcements[0]
+            self.send('$s$FFF//Bet$1EFMania$FFF: {} $FFFhas placed a bet of $s$FE1{} $FFFplanets on team {}.'
+                      .format(nickname, amount, label))
+        else:
+            stakes = OrderedDict()
+
+            for _, amount, label in self.announcements:
+                stakes[label] = stakes.get(label, 0) + amount
+
+            self.send('$s$FFF//Bet$1EFMania$FFF: $FE1{} $FFFnew bets in the last {}s, {}.'
+                      .format(len(self.announcements), max(1, round(time.monotonic() - self.last_summary)),
+                              ', '.join('$FE1{} $FFFplanets on {}$FFF'.format(amount, label)
+                                        for label, amount in stakes.items())))
+
+        self.announcements = list()
+        self.last_summary = time.monotonic()
+
+    async def run(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+
+            try:
+                await self.flush()
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                logger.exception('Could not send chat messages')
+
+    async def flush(self):
+        now = time.monotonic()
+        self.tokens = min(self.rate, self.tokens + (now - self.last_refill) * self.rate)
+        self.last_refill = now
+
+        if self.announcements and now - self.last_summary >= self.summary_interval:
+            self.flush_announcements()
+
+        budget = min(int(self.tokens), len(self))
+
+        if budget < 1:
+            return
+
+        urgent = min(budget, len(self.queue))
+        batch = [self.queue.popleft() for _ in range(urgent)]
+        notices = [self.notices.popleft() for _ in range(budget - urgent)]
+        batch += notices
+        recipients = OrderedDict()
+
+        for message, logins in batch:
+            recipients.setdefault(logins, list()).append(message)
+
+        self.tokens -= budget
+
+        try:
+            with self.app.metrics.timer('gbx_call', method='Chat'):
+                results = await self.app.instance.gbx.multicall(*[self.app.instance.chat(message, *logins)
+                                                                  for logins, messages in recipients.items()
+                                                                  for message in messages])
+        except Exception:
+            # The messages are sent again with the next flush, in their original order
+            self.queue.extendleft(reversed(batch[:urgent]))
+            self.notices.extendleft(reversed(notices))
+            raise
+
+        self.sent += budget
+        self.app.metrics.inc('chat_messages', budget)
+
+        if self.app.recorder.active:
+            for (logins, message), result in zip([(logins, message) for logins, messages in recipients.items()
+                                                  for message in messages], results):
+                self.app.recorder.gbx('Chat', (message, logins), result)
@@ -0,0 +1,94 @@
+import time
+
+from array import array
+
+SPARKS = '▁▂▃▄▅▆▇█'
+
+
+class QuotaHistory:
+    """
+    Quota and stake samples of a bet in a fixed-size ring buffer. Each value is kept in a flat array with one slot per
+    sample, so the memory used is bounded by the size no matter how long the bet stays open. The oldest samples are
+    overwritten once the buffer is full.
+    """
+
+    __slots__ = ('teams', 'size', 'times', 'stakes', 'quotas', 'stacks', 'count')
+
+    def __init__(self, teams, size=360):
+        self.teams = list(teams)
+        self.size = max(1, size)
+        self.times = array('d', [0.0]) * self.size
+        self.stakes = array('d', [0.0]) * self.size
+        self.quotas = {team: array('d', [0.0]) * self.size for team in self.teams}
+        self.stacks = {team: array('q', [0]) * self.size for team in self.teams}
+        self.count = 0
+
+    def __len__(self):
+        return min(self.count, self.size)
+
+    def sample(self, pool, timestamp=None):
+        # Teams without a quota are stored with a quota of 0
+        index = self.count % self.size
+        quotas = pool.quotas()
+
+        self.times[index] = time.time() if timestamp is None else timestamp
+        self.stakes[index] = pool.stake
+
+        for team in self.teams:
+            self.quotas[team][index] = quotas.get(team) or 0.0
+            self.stacks[team][index] = pool.stack.get(team, 0)
+
+        self.count += 1
+
+    def ordered(self, column):
+        # Returns the samples of one of the arrays, oldest first
+        if self.count <= self.size:
+            return column[:self.count]
+
+        start = self.count % self.size
+        return column[start:] + column[:start]
+
+    def downsample(self, points):
+        """
+        Returns a copy reduced to the given number of samples, keeping the last sample of each equally sized bucket.
+        Used to archive the history of a finished bet.
+        """
+        indices = buckets(len(self), points)
+        archive = QuotaHistory(self.teams, size=len(indices))
+
+        archive.times = pick(self.ordered(self.times), indices)
+        archive.stakes = pick(self.ordered(self.stakes), indices)
+        archive.quotas = {team: pick(self.ordered(self.quotas[team]), indices) for team in self.teams}
+        archive.stacks = {team: pick(self.ordered(self.stacks[team]), indices) for team in self.teams}
+        archive.count = len(indices)
+
+        return archive
+
+
+def buckets(count, points):
+    # Index of the last sample of each bucket when splitting count samples into the given number of buckets
+    if count <= points:
+        return list(range(count))
+
+    return [(bucket + 1) * count // points - 1 for bucket in range(points)]
+
+
+def pick(values, indices):
+    return array(values.typecode, [values[index] for index in indices])
+
+
+def sparkline(values, width=24):
+    """
+    Renders a series of values as a line of block characters, scaled between the minimum and maximum value.
+    """
+    values = [values[index] for index in buckets(len(values), width)]
+
+    if not values:
+        return ''
+
+    low, high = min(values), max(values)
+
+    if high == low:
+        return SPARKS[0] * len(values)
+
+    return ''.join(SPARKS[int((value - low) / (high - low) * (len(SPARKS) - 1))] for value in values)
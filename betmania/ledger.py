@@ -0,0 +1,215 @@
+import asyncio
+import json
+import logging
+import sqlite3
+import time
+
+from concurrent.futures import ThreadPoolExecutor
+
+logger = logging.getLogger(__name__)
+
+
+class BetLedger:
+    """
+    Append-only ledger of all bet events, stored in a local SQLite database. Events are queued in memory and
+    group-committed by a background task, so the betting callbacks never wait on the disk. A snapshot of the app state
+    is written every few hundred events, which keeps the tail to replay on start short.
+    """
+
+    def __init__(self, path, state_provider, flush_interval=0.05, snapshot_interval=500):
+        self.path = path
+        self.state_provider = state_provider
+        self.flush_interval = flush_interval
+        self.snapshot_interval = snapshot_interval
+
+        self.connection = None
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        self.queue = list()
+        self.seq = 0
+        self.events_since_snapshot = 0
+        self.failing = False
+        self.task = None
+
+    async def open(self):
+        await self.run_in_executor(self._open)
+        self.task = asyncio.ensure_future(self.run())
+
+    async def close(self):
+        if self.task:
+            self.task.cancel()
+            self.task = None
+
+        await self.flush()
+        await self.run_in_executor(self.connection.close)
+        self.executor.shutdown(wait=False)
+
+    async def run_in_executor(self, func, *args):
+        return await asyncio.get_event_loop().run_in_executor(self.executor, func, *args)
+
+    def append(self, event, **data):
+        self.seq += 1
+        self.queue.append(('event', self.seq, time.time(), event, json.dumps(data)))
+        self.events_since_snapshot += 1
+
+        if self.events_since_snapshot >= self.snapshot_interval:
+            self.snapshot()
+
+    def snapshot(self):
+        # The state is captured right away, so it matches exactly the events queued up to this point
+        self.queue.append(('snapshot', self.seq, time.time(), None, json.dumps(self.state_provider())))
+        self.events_since_snapshot = 0
+
+    async def run(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+
+            if self.queue:
+                await self.flush()
+
+    async def flush(self):
+        if not self.queue or not self.connection:
+            return
+
+        batch, self.queue = self.queue, list()
+
+        try:
+            await self.run_in_executor(self._write, batch)
+        except Exception:
+            # The batch is written again with the next flush, the failure is only logged once until it succeeds
+            self.queue = batch + self.queue
+
+            if not self.failing:
+                logger.exception('Could not write {} entries to the bet ledger'.format(len(batch)))
+
+            self.failing = True
+            return
+
+        if self.failing:
+            logger.info('Bet ledger writes succeed again')
+            self.failing = False
+
+    async def load(self):
+        """
+        Loads the latest snapshot and all events written after it.
+
+        :return: Tuple of the snapshot state (or None) and the list of (event, data) tuples to replay.
+        """
+        state, events, seq = await self.run_in_executor(self._load)
+        self.seq = seq
+        return state, events
+
+    def _open(self):
+        self.connection = sqlite3.connect(self.path, check_same_thread=False)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute('PRAGMA synchronous=NORMAL')
+        self.connection.execute('CREATE TABLE IF NOT EXISTS events '
+                                '(seq INTEGER PRIMARY KEY, time REAL, event TEXT, data TEXT)')
+        self.connection.execute('CREATE TABLE IF NOT EXISTS snapshots (seq INTEGER PRIMARY KEY, time REAL, state TEXT)')
+        self.connection.commit()
+
+    def _write(self, batch):
+        events = [(seq, timestamp, event, data) for kind, seq, timestamp, event, data in batch if kind == 'event']
+        snapshots = [(seq, timestamp, data) for kind, seq, timestamp, event, data in batch if kind == 'snapshot']
+
+        with self.connection:
+            self.connection.executemany('INSERT INTO events (seq, time, event, data) VALUES (?, ?, ?, ?)', events)
+
+            if snapshots:
+                self.connection.execute('INSERT OR REPLACE INTO snapshots (seq, time, state) VALUES (?, ?, ?)',
+                                        snapshots[-1])
+                self.connection.execute('DELETE FROM snapshots WHERE seq < ?', (snapshots[-1][0],))
+                self.connection.execute('DELETE FROM events WHERE seq <= ?', (snapshots[-1][0],))
+
+    def _load(self):
+        row = self.connection.execute('SELECT seq, state FROM snapshots ORDER BY seq DESC LIMIT 1').fetchone()
+        snapshot_seq, state = (row[0], json.loads(row[1])) if row else (0, None)
+
+        rows = self.connection.execute('SELECT seq, event, data FROM events WHERE seq > ? ORDER BY seq',
+                                       (snapshot_seq,)).fetchall()
+        events = [(event, json.loads(data)) for _, event, data in rows]
+        seq = rows[-1][0] if rows else snapshot_seq
+
+        return state, events, seq
+
+    @staticmethod
+    def replay(state, events):
+        """
+        Applies the given events to a snapshot state and returns the resulting state. Only markets with an unresolved
+        bet and payouts which haven't been sent yet are kept. Unpaid bills are kept even if their bet is over, so they
+        can still be refunded.
+        """
+        if state is None:
+            state = dict(markets=dict(), bets=dict(), outbox=dict())
+
+        markets = state.get('markets', dict())
+        bets = {int(bill_id): bet for bill_id, bet in state.get('bets', dict()).items() if 'market' in bet}
+        outbox = state.get('outbox', dict())
+
+        for event, data in events:
+            market_id = data.get('market')
+
+            if event == 'open':
+                markets[market_id] = dict(bet_open=True, bet_current=True, min_bet=data['min_bet'],
+                                          max_bet=data['max_bet'], teams=data['teams'], bet_id=data.get('bet_id'),
+                                          supporters={team: dict() for team in data['teams']})
+            elif event == 'join' and market_id in markets:
+                markets[market_id]['cycle'] = data['cycle']
+                markets[market_id]['pushed'] = dict()
+            elif event == 'shared_push':
+                cycles = {market.get('cycle'): market for market in markets.values() if market.get('cycle') is not None}
+
+                for cycle, team, login, amount in data['deltas']:
+                    if cycle in cycles:
+                        stakes = cycles[cycle].setdefault('pushed', dict()).setdefault(team, dict())
+                        stakes[login] = stakes.get(login, 0) + amount
+            elif event in ('reopen', 'close') and market_id in markets:
+                markets[market_id]['bet_open'] = event == 'reopen'
+            elif event == 'bill_sent':
+                bets[data['bill_id']] = dict(market=market_id, bet_id=data.get('bet_id'), login=data['login'],
+                                             nickname=data['nickname'], amount=data['amount'], team=data['team'])
+            elif event == 'bill_confirmed':
+                bet = bets.pop(data['bill_id'], None)
+                market = markets.get(bet['market']) if bet else None
+
+                # Bills of an earlier bet of the market have been refunded instead
+                if market and bet.get('bet_id') == market.get('bet_id') and bet['team'] in market['supporters']:
+                    supporters = market['supporters'][bet['team']]
+                    supporters[bet['login']] = supporters.get(bet['login'], 0) + bet['amount']
+            elif event == 'bill_refused':
+                bets.pop(data['bill_id'], None)
+            elif event == 'resolve':
+                markets.pop(market_id, None)
+            elif event == 'reset':
+                markets.pop(market_id, None)
+            elif event == 'outbox':
+                payouts = {str(index): payout for index, payout in enumerate(data['payouts'])}
+                outbox[data['batch']] = dict(kind=data['kind'], message=data['message'], notice=data['notice'],
+                                             payouts=payouts, sending=list())
+            elif event in ('payout_sending', 'payout_retry'):
+                for key in data['keys']:
+                    batch = outbox.get(key.rsplit(':', 1)[0])
+
+                    if batch is None:
+                        continue
+
+                    if event == 'payout_sending':
+                        batch['sending'].append(key)
+                    elif key in batch['sending']:
+                        batch['sending'].remove(key)
+            elif event in ('payout', 'refund', 'payout_failed') and 'key' in data:
+                batch_id, index = data['key'].rsplit(':', 1)
+                batch = outbox.get(batch_id)
+
+                if batch is not None:
+                    batch['payouts'].pop(index, None)
+
+                    if data['key'] in batch['sending']:
+                        batch['sending'].remove(data['key'])
+
+                    if not batch['payouts']:
+                        del outbox[batch_id]
+
+        state['markets'] = markets
+        state['bets'] = bets
+        state['outbox'] = outbox
+        return state
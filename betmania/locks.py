@@ -0,0 +1,14 @@
+import asyncio
+
+
+class ShardedLock:
+    """
+    Fixed set of asyncio locks. Keys are hashed onto the shards, so calls for the same key are serialized while calls
+    for different keys can run at the same time.
+    """
+
+    def __init__(self, shards=64):
+        self.locks = [asyncio.Lock() for _ in range(shards)]
+
+    def __call__(self, key):
+        return self.locks[hash(key) % len(self.locks)]
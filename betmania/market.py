@@ -0,0 +1,85 @@
+import itertools
+import time
+
+from .history import QuotaHistory
+from .pool import BetPool
+
+BET_IDS = itertools.count(1)
+
+
+class Market:
+    """
+    A single betting market with its own outcomes (teams), stake limits and pool. Markets are independent of each
+    other, so several bets can be open at the same time.
+    """
+
+    __slots__ = ('id', 'default', 'teams', 'team_colors', 'bet_open', 'bet_current', 'min_bet', 'max_bet', 'pool',
+                 'bet_id', 'cycle', 'history')
+
+    def __init__(self, market_id, teams, team_colors, margin=0, margin_relative=False, default=False):
+        self.id = market_id
+        self.default = default
+        self.bet_open = False
+        self.bet_current = False
+        self.min_bet = 1
+        self.max_bet = 2500
+        self.pool = BetPool(margin=margin, margin_relative=margin_relative)
+        self.bet_id = None
+        self.cycle = None
+        self.configure_teams(teams, team_colors)
+
+    def configure_teams(self, teams, team_colors):
+        self.teams = list(teams)
+        self.team_colors = {team: team_colors.get(team, '$s$DDD') for team in self.teams}
+        self.pool.reset(self.teams)
+        self.history = QuotaHistory(self.teams)
+
+    def new_bet(self):
+        # Every opened bet gets its own id, bills of an earlier bet of this market are told apart by it
+        self.bet_id = '{}-{:x}-{}'.format(self.id, int(time.time() * 1000), next(BET_IDS))
+
+    @property
+    def prefix(self):
+        # Chat prefix of all messages concerning this market. The default market keeps the plain prefix.
+        if self.default:
+            return '$s$FFF//Bet$1EFMania$FFF: '
+
+        return '$s$FFF//Bet$1EFMania $FFF[$1EF{}$FFF]: '.format(self.id)
+
+    def label(self, team):
+        if self.default:
+            return '{}{}'.format(self.team_colors.get(team, '$s$DDD'), team)
+
+        return '{}{} $FFF({})'.format(self.team_colors.get(team, '$s$DDD'), team, self.id)
+
+    def state(self):
+        return dict(bet_open=self.bet_open, bet_current=self.bet_current, min_bet=self.min_bet, max_bet=self.max_bet,
+                    teams=self.teams, supporters=self.pool.supporters, bet_id=self.bet_id, cycle=self.cycle)
+
+
+class MarketRegistry:
+    """
+    All markets of the app, keyed by their id. The default market is used whenever a command doesn't name a market.
+    """
+
+    def __init__(self, default='main'):
+        self.default = default
+        self.markets = dict()
+
+    def __iter__(self):
+        return iter(list(self.markets.values()))
+
+    def __len__(self):
+        return len(self.markets)
+
+    def get(self, market_id=None):
+        return self.markets.get(market_id or self.default)
+
+    def add(self, market):
+        self.markets[market.id] = market
+        return market
+
+    def remove(self, market_id):
+        # The default market always stays available
+        if market_id != self.default:
+            self.markets.pop(market_id, None)
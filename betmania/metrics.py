@@ -0,0 +1,135 @@
+import os
+import time
+
+from collections import Counter, defaultdict, deque
+
+
+class Metrics:
+    """
+    Counters and timings of the app's hot paths. Timings keep their count and sum plus a bounded reservoir of the
+    latest samples, which is used for the percentiles.
+    """
+
+    def __init__(self, samples=1024, rate_window=60):
+        self.samples = samples
+        self.rate_window = rate_window
+
+        self.counters = Counter()
+        self.timings = defaultdict(lambda: deque(maxlen=self.samples))
+        self.totals = defaultdict(lambda: [0, 0.0])
+        self.events = defaultdict(lambda: deque(maxlen=10000))
+        self.gauges = dict()
+
+    def inc(self, name, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        self.counters[key] += value
+        self.events[key].append((time.monotonic(), value))
+
+    def observe(self, name, seconds, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        self.timings[key].append(seconds)
+        self.totals[key][0] += 1
+        self.totals[key][1] += seconds
+
+    def timer(self, name, **labels):
+        return Timer(self, name, labels)
+
+    def lock(self, name, lock):
+        return LockTimer(self, name, lock)
+
+    def rate(self, name, **labels):
+        # Events per second within the rate window
+        events = self.events[(name, tuple(sorted(labels.items())))]
+        since = time.monotonic() - self.rate_window
+        return sum(value for timestamp, value in events if timestamp >= since) / self.rate_window
+
+    def summary(self, key):
+        values = sorted(self.timings[key])
+        count, total = self.totals[key]
+
+        if not values:
+            return dict(count=count, avg=0.0, p50=0.0, p99=0.0, max=0.0)
+
+        return dict(count=count, avg=total / count, max=values[-1], p50=values[int(0.5 * (len(values) - 1))],
+                    p99=values[int(0.99 * (len(values) - 1))])
+
+    def prometheus(self):
+        """
+        Returns all metrics in the Prometheus text exposition format.
+        """
+        lines = list()
+        typed = set()
+
+        def labels(pairs, **extra):
+            pairs = list(pairs) + sorted(extra.items())
+            return '{' + ','.join('{}="{}"'.format(k, v) for k, v in pairs) + '}' if pairs else ''
+
+        def declare(name, kind):
+            if name not in typed:
+                typed.add(name)
+                lines.append('# TYPE {} {}'.format(name, kind))
+
+        for (name, pairs), value in sorted(self.counters.items()):
+            metric = 'betmania_{}_total'.format(name)
+            declare(metric, 'counter')
+            lines.append('{}{} {}'.format(metric, labels(pairs), value))
+
+        for (name, pairs) in sorted(self.timings):
+            metric = 'betmania_{}_seconds'.format(name)
+            summary = self.summary((name, pairs))
+            declare(metric, 'summary')
+            lines.append('{}{} {:.6f}'.format(metric, labels(pairs, quantile='0.5'), summary['p50']))
+            lines.append('{}{} {:.6f}'.format(metric, labels(pairs, quantile='0.99'), summary['p99']))
+            lines.append('{}_count{} {}'.format(metric, labels(pairs), summary['count']))
+            lines.append('{}_sum{} {:.6f}'.format(metric, labels(pairs), self.totals[(name, pairs)][1]))
+
+        for name, value in sorted(self.gauges.items()):
+            metric = 'betmania_{}'.format(name)
+            declare(metric, 'gauge')
+            lines.append('{} {}'.format(metric, value))
+
+        return '\n'.join(lines) + '\n'
+
+    def write(self, path):
+        # Writes to a temporary file first, so scrapers never read a partially written file
+        with open(path + '.tmp', 'w') as file:
+            file.write(self.prometheus())
+
+        os.replace(path + '.tmp', path)
+
+
+class Timer:
+    def __init__(self, metrics, name, labels):
+        self.metrics = metrics
+        self.name = name
+        self.labels = labels
+        self.started = 0.0
+
+    def __enter__(self):
+        self.started = time.monotonic()
+        return self
+
+    def __exit__(self, *exc):
+        self.metrics.observe(self.name, time.monotonic() - self.started, **self.labels)
+
+
+class LockTimer:
+    """
+    Async context manager acquiring a lock and recording the time spent waiting for and holding it.
+    """
+
+    def __init__(self, metrics, name, lock):
+        self.metrics = metrics
+        self.name = name
+        self.lock = lock
+        self.acquired = 0.0
+
+    async def __aenter__(self):
+        started = time.monotonic()
+        await self.lock.acquire()
+        self.acquired = time.monotonic()
+        self.metrics.observe('lock_wait', self.acquired - started, lock=self.name)
+
+    async def __aexit__(self, *exc):
+        self.metrics.observe('lock_hold', time.monotonic() - self.acquired, lock=self.name)
+        self.lock.release()
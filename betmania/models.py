@@ -0,0 +1,40 @@
+"""
+BetMania Models. Aggregated betting statistics which outlive a single bet.
+"""
+from peewee import BigIntegerField, CharField, IntegerField
+from pyplanet.core.db import TimedModel
+
+
+class PlayerBetStats(TimedModel):
+    login = CharField(max_length=100, unique=True)
+    """
+    Login of the player.
+    """
+
+    wagered = BigIntegerField(default=0, index=True)
+    """
+    Total amount of planets the player has bet on resolved bets.
+    """
+
+    won = BigIntegerField(default=0)
+    """
+    Total amount of planets paid out to the player.
+    """
+
+    profit = BigIntegerField(default=0, index=True)
+    """
+    Net profit of the player (won - wagered), used to rank the leaderboard.
+    """
+
+    bets = IntegerField(default=0)
+    """
+    Number of resolved bets the player took part in.
+    """
+
+    wins = IntegerField(default=0)
+    """
+    Number of resolved bets the player has won.
+    """
+
+    class Meta:
+        db_table = 'betmania_player_stats'
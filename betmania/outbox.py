@@ -0,0 +1,349 @@
+import asyncio
+import itertools
+import logging
+import math
+import time
+
+from collections import OrderedDict
+
+from .payout import PayoutReport
+
+logger = logging.getLogger(__name__)
+
+
+class PayoutIntent:
+    __slots__ = ('key', 'batch', 'login', 'amount', 'attempts', 'deferrals', 'due', 'sending')
+
+    def __init__(self, key, batch, login, amount):
+        self.key = key
+        self.batch = batch
+        self.login = login
+        self.amount = amount
+        self.attempts = 0
+        self.deferrals = 0
+        self.due = 0.0
+        self.sending = False
+
+
+class PayoutBatch:
+    """
+    Payouts of a single resolution, reset or late refund. The admin who triggered it receives the report once all of
+    its payouts are either paid or given up.
+    """
+
+    __slots__ = ('id', 'kind', 'message', 'notice', 'player', 'pending', 'report', 'created')
+
+    def __init__(self, batch_id, kind, message, notice=None, player=None):
+        self.id = batch_id
+        self.kind = kind
+        self.message = message
+        self.notice = notice
+        self.player = player
+        self.pending = 0
+        self.report = PayoutReport()
+        self.created = time.monotonic()
+
+
+class PayoutOutbox:
+    """
+    Queue of payouts drained by a background worker. Resolving or resetting a bet only adds the payouts to the outbox
+    and returns. The worker reads the server planets once per run, sends the due payouts as batched Pay multicalls with
+    a bounded concurrency and retries failed payments with an exponential backoff. Payments the server can't afford
+    are deferred with the same backoff, they don't count as attempts and are never given up.
+
+    Every payout has an idempotency key. The ledger records the key when the payout is queued, right before it is sent
+    and once it went through, so a restart neither loses a queued payout nor sends a paid one again. Payouts which
+    were sent but not confirmed, either before a restart or by a multicall failing as a whole, are not retried, they
+    are logged for a manual check instead.
+    """
+
+    def __init__(self, app, batch_size=20, concurrency=4, base_delay=2.0, max_delay=300.0, max_attempts=10):
+        self.app = app
+        self.batch_size = batch_size
+        self.concurrency = concurrency
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.max_attempts = max_attempts
+
+        self.intents = OrderedDict()
+        self.batches = dict()
+        self.uncertain = list()
+        self.ids = itertools.count(1)
+        self.prefix = '{:x}'.format(int(time.time() * 1000))
+        self.retries = 0
+        self.given_up = 0
+        self.wakeup = None
+        self.task = None
+
+    def __len__(self):
+        return len(self.intents)
+
+    @property
+    def amount(self):
+        return sum(intent.amount for intent in self.intents.values())
+
+    @property
+    def deferred(self):
+        # Queued payouts waiting for the server to have enough planets
+        return sum(1 for intent in self.intents.values() if intent.deferrals)
+
+    @property
+    def age(self):
+        # Seconds the oldest queued payout has been waiting
+        if not self.intents:
+            return 0.0
+
+        return time.monotonic() - min(intent.batch.created for intent in self.intents.values())
+
+    @staticmethod
+    def payment_cost(amount):
+        # Every payment costs the server 2 planets plus 5% fees on top of the paid amount
+        return amount + 2 + math.floor(amount * 0.05)
+
+    @staticmethod
+    def is_fault(result):
+        return result is None or isinstance(result, Exception) or (isinstance(result, dict) and 'faultCode' in result)
+
+    def start(self):
+        self.wakeup = asyncio.Event()
+        self.task = asyncio.ensure_future(self.run())
+
+        if self.intents:
+            self.wakeup.set()
+
+    def stop(self):
+        if self.task:
+            self.task.cancel()
+            self.task = None
+
+        if self.intents and not self.app.ledger:
+            logger.warning('{} queued payouts ({} planets) are lost, no ledger is configured'
+                           .format(len(self.intents), self.amount))
+
+    def enqueue(self, kind, payouts, message, notice=None, player=None):
+        """
+        Adds the payouts of a resolution, reset or refund to the outbox.
+
+        :param kind: Kind of the payouts, either 'payout' or 'refund'.
+        :param payouts: List of (login, amount) tuples.
+        :param message: Message attached to each payment.
+        :param notice: Optional chat message sent to each paid player. May contain an {amount} placeholder.
+        :param player: Optional admin who receives the report once all payouts are done.
+        :rtype: PayoutBatch
+        """
+        payouts = [(login, amount) for login, amount in payouts if amount > 0]
+        batch = PayoutBatch('{}-{}'.format(self.prefix, next(self.ids)), kind, message, notice, player)
+
+        if not payouts:
+            self.finish(batch)
+            return batch
+
+        # The intents are added first, a ledger snapshot taken by the record has to contain them
+        self.add(batch, {str(index): payout for index, payout in enumerate(payouts)})
+        self.app.record('outbox', batch=batch.id, kind=kind, message=message, notice=notice, payouts=payouts)
+
+        return batch
+
+    def add(self, batch, payouts):
+        self.batches[batch.id] = batch
+
+        for index, (login, amount) in payouts.items():
+            intent = PayoutIntent('{}:{}'.format(batch.id, index), batch, login, amount)
+            self.intents[intent.key] = intent
+            batch.pending += 1
+
+        if self.wakeup:
+            self.wakeup.set()
+
+    def restore(self, outbox):
+        """
+        Queues the payouts of the ledger state again. Payouts which were about to be sent when the app stopped are
+        given up, as the server may have paid them already.
+        """
+        for batch_id, data in outbox.items():
+            batch = PayoutBatch(batch_id, data['kind'], data['message'], data['notice'])
+            payouts = data['payouts']
+
+            for key in data.get('sending', list()):
+                index = key.rsplit(':', 1)[1]
+
+                if index in payouts:
+                    login, amount = payouts.pop(index)
+                    self.uncertain.append((login, amount, key))
+                    self.app.record('payout_failed', key=key, reason='uncertain')
+                    logger.warning('Payout {} of {} planets to {} was sent before the restart without a confirmation, '
+                                   'please check it manually'.format(key, amount, login))
+
+            if payouts:
+                self.add(batch, payouts)
+
+        if self.intents:
+            logger.info('Restored {} queued payouts ({} planets) from the ledger'
+                        .format(len(self.intents), self.amount))
+
+    def state(self):
+        # Queued payouts for the ledger snapshot, in the same form as the ledger replay builds them
+        outbox = dict()
+
+        for intent in self.intents.values():
+            batch = outbox.setdefault(intent.batch.id, dict(kind=intent.batch.kind, message=intent.batch.message,
+                                                             notice=intent.batch.notice, payouts=dict(),
+                                                             sending=list()))
+            batch['payouts'][intent.key.rsplit(':', 1)[1]] = [intent.login, intent.amount]
+
+            if intent.sending:
+                batch['sending'].append(intent.key)
+
+        return outbox
+
+    async def drain(self, timeout=None):
+        # Waits until all queued payouts are either paid or given up
+        started = time.monotonic()
+
+        while self.intents and (timeout is None or time.monotonic() - started < timeout):
+            await asyncio.sleep(0.01)
+
+        return not self.intents
+
+    async def run(self):
+        while True:
+            due = [intent.due for intent in self.intents.values() if not intent.sending]
+            timeout = max(0.0, min(due) - time.monotonic()) if due else None
+
+            try:
+                await asyncio.wait_for(self.wakeup.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+
+            self.wakeup.clear()
+
+            try:
+                await self.send_due()
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                logger.exception('Payout run failed')
+
+    async def send_due(self):
+        now = time.monotonic()
+        due = [intent for intent in self.intents.values() if not intent.sending and intent.due <= now]
+
+        if not due:
+            return
+
+        try:
+            with self.app.metrics.timer('gbx_call', method='GetServerPlanets'):
+                planets = await self.app.instance.gbx('GetServerPlanets')
+        except Exception as e:
+            for intent in due:
+                self.retry(intent, str(e))
+            return
+
+        self.app.recorder.gbx('GetServerPlanets', (), planets)
+        plan = list()
+
+        for intent in due:
+            cost = self.payment_cost(intent.amount)
+
+            if cost > planets:
+                self.defer(intent)
+                continue
+
+            planets -= cost
+            intent.deferrals = 0
+            intent.sending = True
+            plan.append(intent)
+
+        semaphore = asyncio.Semaphore(self.concurrency)
+        batches = [plan[i:i + self.batch_size] for i in range(0, len(plan), self.batch_size)]
+
+        await asyncio.gather(*[self.send_batch(batch, semaphore) for batch in batches])
+
+    async def send_batch(self, intents, semaphore):
+        gbx = self.app.instance.gbx
+
+        async with semaphore:
+            self.app.record('payout_sending', keys=[intent.key for intent in intents])
+
+            try:
+                with self.app.metrics.timer('gbx_call', method='Pay'):
+                    results = await gbx.multicall(*[gbx.prepare('Pay', intent.login, intent.amount,
+                                                                intent.batch.message) for intent in intents])
+            except Exception as e:
+                # The server may have executed the calls before the connection failed, sending them again could pay
+                # the players twice
+                for intent in intents:
+                    self.app.recorder.gbx('Pay', (intent.login, intent.amount, intent.batch.message), e)
+                    self.give_up_uncertain(intent, str(e))
+                return
+
+            failed = list()
+
+            for intent, result in zip(intents, results):
+                self.app.recorder.gbx('Pay', (intent.login, intent.amount, intent.batch.message), result)
+
+                if self.is_fault(result):
+                    failed.append(intent)
+                    self.retry(intent, str(result))
+                else:
+                    self.complete(intent)
+
+            if failed:
+                self.app.record('payout_retry', keys=[intent.key for intent in failed])
+
+    def complete(self, intent):
+        batch = intent.batch
+        del self.intents[intent.key]
+
+        self.app.record(batch.kind, key=intent.key, login=intent.login, amount=intent.amount)
+        batch.report.succeeded.append((intent.login, intent.amount))
+
+        if batch.notice:
+            self.app.chat_queue.notify(batch.notice.format(amount=intent.amount), intent.login)
+
+        self.settle(batch)
+
+    def give_up_uncertain(self, intent, reason):
+        del self.intents[intent.key]
+        self.uncertain.append((intent.login, intent.amount, intent.key))
+        self.given_up += 1
+
+        self.app.record('payout_failed', key=intent.key, reason='uncertain')
+        intent.batch.report.failed.append((intent.login, intent.amount, 'unconfirmed: {}'.format(reason)))
+        logger.warning('Payout {} of {} planets to {} was sent without a confirmation ({}), please check it manually'
+                       .format(intent.key, intent.amount, intent.login, reason))
+        self.settle(intent.batch)
+
+    def retry(self, intent, reason):
+        intent.sending = False
+        intent.attempts += 1
+
+        if intent.attempts >= self.max_attempts:
+            del self.intents[intent.key]
+            self.given_up += 1
+
+            self.app.record('payout_failed', key=intent.key, reason=reason)
+            intent.batch.report.failed.append((intent.login, intent.amount, reason))
+            self.settle(intent.batch)
+            return
+
+        self.retries += 1
+        self.app.metrics.inc('payout_retries')
+        intent.due = time.monotonic() + min(self.max_delay, self.base_delay * 2 ** (intent.attempts - 1))
+
+    def defer(self, intent):
+        # The payout stays queued until the server can afford it, the backoff is capped at max_delay
+        intent.deferrals += 1
+        self.app.metrics.inc('payout_deferrals')
+        intent.due = time.monotonic() + min(self.max_delay, self.base_delay * 2 ** (intent.deferrals - 1))
+
+    def settle(self, batch):
+        batch.pending -= 1
+
+        if batch.pending <= 0:
+            self.finish(batch)
+
+    def finish(self, batch):
+        self.batches.pop(batch.id, None)
+        batch.report.duration = time.monotonic() - batch.created
+        asyncio.ensure_future(self.app.report_payouts(batch.report, batch.player, batch.kind))
@@ -0,0 +1,81 @@
+from collections import Counter
+
+
+def allocate(stakes, distributable):
+    """
+    Splits a whole number of planets proportionally to the given stakes, using integer arithmetic only. Each payout is
+    floored first and the planets left over go to the stakes with the largest remainders, so the payouts always sum up
+    to the distributable amount exactly.
+
+    :param stakes: List or dict items view of (login, amount) tuples, it is iterated twice.
+    :param distributable: Whole number of planets to distribute.
+    :return: List of (login, payout) tuples in the order of the stakes.
+    """
+    amounts = [amount for _, amount in stakes]
+    total = sum(amounts)
+
+    if total <= 0 or distributable <= 0:
+        return [(login, 0) for login, _ in stakes]
+
+    # Payouts only depend on the amount, and stakes are capped by the stake limits, so most supporters share their
+    # amount with others. Each distinct amount is computed once and looked up per stake.
+    counts = Counter(amounts)
+    shares = {amount: divmod(amount * distributable, total) for amount in counts}
+    left = distributable - sum(shares[amount][0] * count for amount, count in counts.items())
+    tied = list()
+
+    if left:
+        # Less than one planet per stake is left over and goes to the largest remainders. Only the distinct remainders
+        # are sorted to find the smallest one still receiving a planet.
+        remainders = Counter()
+
+        for amount, (_, remainder) in shares.items():
+            remainders[remainder] += counts[amount]
+
+        for threshold in sorted(remainders, reverse=True):
+            if remainders[threshold] >= left:
+                break
+
+            left -= remainders[threshold]
+
+        if left < remainders[threshold]:
+            # Only some of the stakes with the threshold remainder receive a planet, ties go to the earliest stakes
+            for amount, (_, remainder) in shares.items():
+                if remainder == threshold:
+                    index = -1
+
+                    for _ in range(min(left, counts[amount])):
+                        index = amounts.index(amount, index + 1)
+                        tied.append(index)
+
+            tied = sorted(tied)[:left]
+            threshold += 1
+
+        shares = {amount: share + (remainder >= threshold) for amount, (share, remainder) in shares.items()}
+    else:
+        shares = {amount: share for amount, (share, _) in shares.items()}
+
+    payouts = [(login, shares[amount]) for login, amount in stakes]
+
+    for index in tied:
+        login, payout = payouts[index]
+        payouts[index] = (login, payout + 1)
+
+    return payouts
+
+
+class PayoutReport:
+    """
+    Outcome of a batch of payouts. Contains the successful and failed payments as well as the time from queueing the
+    payouts until the last one was done.
+    """
+
+    def __init__(self):
+        self.succeeded = list()
+        self.failed = list()
+        self.duration = 0.0
+
+    @property
+    def total(self):
+        return sum(amount for _, amount in self.succeeded)
+
@@ -0,0 +1,51 @@
+from collections import OrderedDict
+
+from pyplanet.apps.core.maniaplanet.models import Player
+
+
+class NicknameCache:
+    """
+    LRU cache of player nicknames. Unknown logins are resolved with a single bulk query per chunk of logins.
+    """
+
+    def __init__(self, size=4096, chunk_size=500):
+        self.size = size
+        self.chunk_size = chunk_size
+        self.nicknames = OrderedDict()
+
+    def put(self, login, nickname):
+        self.nicknames[login] = nickname
+        self.nicknames.move_to_end(login)
+
+        while len(self.nicknames) > self.size:
+            self.nicknames.popitem(last=False)
+
+    def invalidate(self, login):
+        self.nicknames.pop(login, None)
+
+    async def resolve(self, logins):
+        """
+        Returns a dict with the nickname of each given login. Logins without a player record map to themselves.
+        """
+        result = dict()
+        missing = list()
+
+        for login in logins:
+            if login in self.nicknames:
+                self.nicknames.move_to_end(login)
+                result[login] = self.nicknames[login]
+            else:
+                missing.append(login)
+
+        for i in range(0, len(missing), self.chunk_size):
+            chunk = missing[i:i + self.chunk_size]
+            rows = await Player.execute(Player.select(Player.login, Player.nickname).where(Player.login.in_(chunk)))
+
+            for row in rows:
+                result[row.login] = row.nickname
+                self.put(row.login, row.nickname)
+
+        for login in missing:
+            result.setdefault(login, login)
+
+        return result
@@ -0,0 +1,99 @@
+import bisect
+
+from .payout import allocate
+
+
+class BetPool:
+    """
+    Stake state of a bet. Keeps the stack of each team, the running total and the payout quotas up to date, so that
+    a confirmed bill only needs a constant amount of work. The backers index maps each login to its team and stake, so
+    lookups by player don't depend on the number of teams.
+    """
+
+    __slots__ = ('stack', 'supporters', 'rankings', 'backers', 'total', 'stake', 'margin', 'margin_relative',
+                 '_quotas')
+
+    def __init__(self, teams=None, margin=0, margin_relative=False):
+        self.margin = margin
+        self.margin_relative = margin_relative
+        self.reset(teams or list())
+
+    def reset(self, teams):
+        self.stack = {team: 0 for team in teams}
+        self.supporters = {team: dict() for team in teams}
+        self.rankings = {team: list() for team in teams}
+        self.backers = dict()
+        self.total = 0
+        self.update_stake()
+
+    def configure(self, margin, margin_relative):
+        self.margin = margin
+        self.margin_relative = margin_relative
+        self.update_stake()
+
+    def add(self, team, login, amount):
+        supporters = self.supporters[team]
+        ranking = self.rankings[team]
+
+        # Keeps each team's supporters sorted by their stake (highest first) as (-amount, login) entries
+        if login in supporters:
+            del ranking[bisect.bisect_left(ranking, (-supporters[login], login))]
+
+        supporters[login] = supporters.get(login, 0) + amount
+        bisect.insort(ranking, (-supporters[login], login))
+        self.backers[login] = (team, supporters[login])
+
+        self.stack[team] += amount
+        self.total += amount
+        self.update_stake()
+
+    def merge(self, team, amount):
+        # Adds stake placed on other instances of a shared pool, which has no local supporters
+        self.stack[team] += amount
+        self.total += amount
+        self.update_stake()
+
+    def team_of(self, login):
+        # Returns the team the player has backed, None if the player hasn't placed a bet
+        return self.backers.get(login, (None, 0))[0]
+
+    def amount_of(self, login):
+        return self.backers.get(login, (None, 0))[1]
+
+    def stakes(self):
+        # Returns the (login, amount) stakes of all supporters, regardless of their team
+        return [(login, amount) for login, (_, amount) in self.backers.items()]
+
+    def ranked(self, team, start=0, stop=None):
+        # Returns a page of (login, amount) tuples of the team's supporters, sorted by amount
+        return [(login, -amount) for amount, login in self.rankings[team][start:stop]]
+
+    def update_stake(self):
+        # Deducts the server margin from the running total. Quotas are rebuilt on the next read.
+        stake = self.total
+        deduct_amount = self.margin
+
+        if self.margin_relative:
+            if abs(deduct_amount) > 100:
+                deduct_amount %= 100
+
+            stake -= abs(deduct_amount) * (stake / 100)
+        else:
+            stake -= abs(deduct_amount)
+
+        self.stake = stake
+        self._quotas = None
+
+    def payouts(self, team):
+        # Splits the stake after the margin among the team's supporters, the payouts sum up to it exactly
+        return allocate(self.supporters[team].items(), int(self.stake))
+
+    def quota(self, team):
+        return self.quotas()[team]
+
+    def quotas(self):
+        if self._quotas is None:
+            self._quotas = {team: round(self.stake / stack, 3) if stack > 0 else None
+                            for team, stack in self.stack.items()}
+
+        return self._quotas
@@ -0,0 +1,115 @@
+import asyncio
+import functools
+import json
+import time
+
+from concurrent.futures import ThreadPoolExecutor
+
+
+class TraceRecorder:
+    """
+    Records command invocations, GBX calls and signals of a betting session into a line-oriented trace file. Each line
+    is a JSON array of the seconds since the start of the recording, the kind of the entry and its payload. Entries are
+    only appended to a list on the hot paths, serializing and writing them is done by a background task.
+    """
+
+    def __init__(self, flush_interval=0.5):
+        self.flush_interval = flush_interval
+
+        self.path = None
+        self.file = None
+        self.buffer = list()
+        self.started = 0.0
+        self.recorded = 0
+        self.task = None
+        self.executor = ThreadPoolExecutor(max_workers=1)
+
+    @property
+    def active(self):
+        return self.file is not None
+
+    async def open(self, path, header):
+        self.file = await asyncio.get_event_loop().run_in_executor(self.executor, functools.partial(open, path, 'a'))
+        self.path = path
+        self.started = time.monotonic()
+        self.write('start', header)
+        self.task = asyncio.ensure_future(self.run())
+
+    async def close(self):
+        if self.task:
+            self.task.cancel()
+            self.task = None
+
+        if self.file:
+            await self.flush()
+            file, self.file, self.path = self.file, None, None
+            await asyncio.get_event_loop().run_in_executor(self.executor, file.close)
+
+    def write(self, kind, *payload):
+        if self.file is not None:
+            self.buffer.append((time.monotonic() - self.started, kind, payload))
+            self.recorded += 1
+
+    def command(self, target):
+        # Wraps a command target, the trace refers to the command by the name of its target method
+        @functools.wraps(target)
+        async def wrapper(player, data, **kwargs):
+            if self.file is not None:
+                self.write('cmd', target.__name__, plain_player(player), vars(data) if data is not None else None)
+
+            return await target(player, data, **kwargs)
+
+        return wrapper
+
+    def signal(self, name, target):
+        @functools.wraps(target)
+        async def wrapper(*args, **kwargs):
+            if self.file is not None:
+                self.write('sig', name, {key: plain(value) for key, value in kwargs.items()})
+
+            return await target(*args, **kwargs)
+
+        return wrapper
+
+    def gbx(self, method, args, result):
+        if self.file is not None:
+            self.write('gbx', method, [plain(arg) for arg in args], plain(result))
+
+    async def run(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+
+            if self.buffer:
+                await self.flush()
+
+    async def flush(self):
+        batch, self.buffer = self.buffer, list()
+        await asyncio.get_event_loop().run_in_executor(self.executor, self._write, self.file, batch)
+
+    @staticmethod
+    def _write(file, batch):
+        file.write(''.join(json.dumps([round(offset, 4), kind] + list(payload), separators=(',', ':'), default=str)
+                           + '\n' for offset, kind, payload in batch))
+        file.flush()
+
+
+def plain_player(player):
+    if player is None:
+        return None
+
+    return dict(login=player.login, nickname=getattr(player, 'nickname', player.login),
+                level=getattr(player, 'level', 0))
+
+
+def plain(value):
+    # Players are recorded by their login, everything else that isn't JSON serializable by its string representation
+    if hasattr(value, 'login'):
+        return value.login
+
+    if isinstance(value, (list, tuple)):
+        return [plain(item) for item in value]
+
+    if isinstance(value, dict):
+        return {key: plain(item) for key, item in value.items()}
+
+    return value
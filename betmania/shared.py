@@ -0,0 +1,402 @@
+import asyncio
+import logging
+import sqlite3
+
+from abc import ABC, abstractmethod
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+
+from .pool import BetPool
+
+logger = logging.getLogger(__name__)
+
+
+class PoolBackend(ABC):
+    """
+    Storage of a pool shared by several BetMania instances. A market opened on several instances takes part in the same
+    cycle, which collects the stakes of all instances until one of them settles it.
+    """
+
+    @abstractmethod
+    async def open(self):
+        pass
+
+    @abstractmethod
+    async def close(self):
+        pass
+
+    @abstractmethod
+    async def join(self, market_id):
+        """
+        Returns the id of the market's open cycle. A new cycle is started if there's none.
+        """
+
+    @abstractmethod
+    async def sync(self, node, deltas, cursors):
+        """
+        Stores the node's stake deltas and collects the stakes placed on other nodes.
+
+        :param node: Id of the calling node.
+        :param deltas: List of (cycle, team, login, amount) tuples.
+        :param cursors: Dict of the position up to which each tracked cycle has been read by the node.
+        :return: Tuple of the new stakes per cycle and team, the new cursors and a dict of (status, winner) tuples of
+                 all settled cycles which are tracked by the node or still hold payouts for it.
+        """
+
+    @abstractmethod
+    async def settle(self, node, cycle, winner, allocate):
+        """
+        Settles an open cycle with the given winner (or None for a reset) and stores the payouts of all nodes, which
+        are computed by allocate from a list of (node, team, login, amount) tuples.
+
+        :return: List of the calling node's (login, amount) payouts or None if the cycle has been settled already.
+        """
+
+    @abstractmethod
+    async def take(self, node, cycle):
+        """
+        Returns the payouts of a settled cycle not yet taken by the node as (login, kind, amount) tuples, including
+        refunds of stakes which reached the backend after the cycle was settled.
+        """
+
+
+class SqlitePoolBackend(PoolBackend):
+    """
+    Reference backend for instances running on the same host, using a SQLite database in WAL mode. Cycles are settled
+    within a single write transaction, so exactly one node wins the settlement.
+    """
+
+    def __init__(self, path, timeout=5):
+        self.path = path
+        self.timeout = timeout
+        self.connection = None
+        self.executor = ThreadPoolExecutor(max_workers=1)
+
+    async def run_in_executor(self, func, *args):
+        return await asyncio.get_event_loop().run_in_executor(self.executor, func, *args)
+
+    async def open(self):
+        await self.run_in_executor(self._open)
+
+    async def close(self):
+        await self.run_in_executor(self.connection.close)
+        self.executor.shutdown(wait=False)
+
+    async def join(self, market_id):
+        return await self.run_in_executor(self._transaction, self._join, market_id)
+
+    async def sync(self, node, deltas, cursors):
+        return await self.run_in_executor(self._transaction, self._sync, node, deltas, cursors)
+
+    async def settle(self, node, cycle, winner, allocate):
+        return await self.run_in_executor(self._transaction, self._settle, node, cycle, winner, allocate)
+
+    async def take(self, node, cycle):
+        return await self.run_in_executor(self._transaction, self._take, node, cycle)
+
+    def _open(self):
+        self.connection = sqlite3.connect(self.path, timeout=self.timeout, isolation_level=None,
+                                          check_same_thread=False)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute('PRAGMA synchronous=NORMAL')
+        self.connection.execute('CREATE TABLE IF NOT EXISTS cycles (id INTEGER PRIMARY KEY AUTOINCREMENT, market TEXT, '
+                                'status TEXT, winner TEXT, node TEXT, cutoff INTEGER)')
+        self.connection.execute('CREATE TABLE IF NOT EXISTS deltas (seq INTEGER PRIMARY KEY AUTOINCREMENT, '
+                                'cycle INTEGER, node TEXT, team TEXT, login TEXT, amount INTEGER)')
+        self.connection.execute('CREATE INDEX IF NOT EXISTS deltas_cycle ON deltas (cycle, seq)')
+        self.connection.execute('CREATE TABLE IF NOT EXISTS payouts (cycle INTEGER, node TEXT, login TEXT, kind TEXT, '
+                                'amount INTEGER, taken INTEGER, PRIMARY KEY (cycle, node, login, kind))')
+
+    def _transaction(self, func, *args):
+        # Takes the write lock right away, so concurrent nodes are serialized instead of failing on lock upgrades
+        self.connection.execute('BEGIN IMMEDIATE')
+
+        try:
+            result = func(*args)
+        except Exception:
+            self.connection.execute('ROLLBACK')
+            raise
+
+        self.connection.execute('COMMIT')
+        return result
+
+    def _join(self, market_id):
+        row = self.connection.execute('SELECT id FROM cycles WHERE market = ? AND status = ?',
+                                      (market_id, 'open')).fetchone()
+
+        if row:
+            return row[0]
+
+        return self.connection.execute('INSERT INTO cycles (market, status) VALUES (?, ?)',
+                                       (market_id, 'open')).lastrowid
+
+    def _sync(self, node, deltas, cursors):
+        self.connection.executemany('INSERT INTO deltas (cycle, node, team, login, amount) VALUES (?, ?, ?, ?, ?)',
+                                    [(cycle, node, team, login, amount) for cycle, team, login, amount in deltas])
+
+        stakes = dict()
+
+        for cycle, since in cursors.items():
+            rows = self.connection.execute('SELECT team, SUM(amount), MAX(seq) FROM deltas '
+                                           'WHERE cycle = ? AND node != ? AND seq > ? GROUP BY team',
+                                           (cycle, node, since)).fetchall()
+            stakes[cycle] = {team: amount for team, amount, _ in rows}
+            cursors[cycle] = max([since] + [seq for _, _, seq in rows])
+
+        settled = dict()
+
+        if cursors:
+            settled.update((cycle, (status, winner)) for cycle, status, winner in self.connection.execute(
+                'SELECT id, status, winner FROM cycles WHERE status != ? AND id IN ({})'
+                .format(','.join('?' * len(cursors))), ['open'] + list(cursors)))
+
+        settled.update((cycle, (status, winner)) for cycle, status, winner in self.connection.execute(
+            'SELECT DISTINCT cycles.id, cycles.status, cycles.winner FROM payouts JOIN cycles ON cycles.id = '
+            'payouts.cycle WHERE payouts.node = ? AND payouts.taken = 0', (node,)))
+
+        return stakes, cursors, settled
+
+    def _settle(self, node, cycle, winner, allocate):
+        row = self.connection.execute('SELECT status FROM cycles WHERE id = ?', (cycle,)).fetchone()
+
+        if row is None or row[0] != 'open':
+            return None
+
+        cutoff = self.connection.execute('SELECT IFNULL(MAX(seq), 0) FROM deltas').fetchone()[0]
+        stakes = self.connection.execute('SELECT node, team, login, SUM(amount) FROM deltas WHERE cycle = ? '
+                                         'GROUP BY node, team, login', (cycle,)).fetchall()
+        payouts = allocate(stakes)
+        kind = 'payout' if winner else 'refund'
+
+        # Payouts of the settling node are sent by itself right away and are therefore stored as taken
+        self.connection.executemany('INSERT INTO payouts (cycle, node, login, kind, amount, taken) '
+                                    'VALUES (?, ?, ?, ?, ?, ?)',
+                                    [(cycle, payout_node, login, kind, amount, int(payout_node == node))
+                                     for payout_node, login, amount in payouts])
+        self.connection.execute('UPDATE cycles SET status = ?, winner = ?, node = ?, cutoff = ? WHERE id = ?',
+                                ('resolved' if winner else 'reset', winner, node, cutoff, cycle))
+
+        return [(login, amount) for payout_node, login, amount in payouts if payout_node == node]
+
+    def _take(self, node, cycle):
+        cutoff = self.connection.execute('SELECT cutoff FROM cycles WHERE id = ?', (cycle,)).fetchone()[0]
+
+        # Stakes pushed after the settlement weren't part of it and are refunded
+        self.connection.execute('INSERT OR IGNORE INTO payouts (cycle, node, login, kind, amount, taken) '
+                                'SELECT cycle, node, login, ?, SUM(amount), 0 FROM deltas '
+                                'WHERE cycle = ? AND node = ? AND seq > ? GROUP BY login',
+                                ('late', cycle, node, cutoff))
+
+        rows = self.connection.execute('SELECT login, kind, amount FROM payouts WHERE cycle = ? AND node = ? AND '
+                                       'taken = 0', (cycle, node)).fetchall()
+        self.connection.execute('UPDATE payouts SET taken = 1 WHERE cycle = ? AND node = ?', (cycle, node))
+
+        return rows
+
+
+class SharedPool:
+    """
+    Shares the pools of several BetMania instances through a backend. Confirmed stakes are merged into deltas per
+    player and pushed every interval, in the same round trip which pulls the stakes placed on the other instances. A
+    cycle is settled by exactly one instance, the others pick up their payouts on their next sync.
+    """
+
+    def __init__(self, app, backend, node, interval=0.25):
+        self.app = app
+        self.backend = backend
+        self.node = node
+        self.interval = interval
+
+        self.deltas = Counter()
+        self.pushed = dict()
+        self.markets = dict()
+        self.cursors = dict()
+        self.task = None
+
+    async def start(self):
+        await self.backend.open()
+        self.task = asyncio.ensure_future(self.run())
+
+    async def stop(self):
+        if self.task:
+            self.task.cancel()
+            self.task = None
+
+        try:
+            await self.sync()
+        finally:
+            await self.backend.close()
+
+    async def join(self, market):
+        market.cycle = await self.backend.join(market.id)
+        self.track(market)
+
+    def track(self, market):
+        self.markets[market.cycle] = market.id
+        self.cursors.setdefault(market.cycle, 0)
+        self.pushed.setdefault(market.cycle, dict())
+
+    def untrack(self, cycle):
+        self.cursors.pop(cycle, None)
+        self.pushed.pop(cycle, None)
+        return self.markets.pop(cycle, None)
+
+    def restore(self, market, pushed):
+        """
+        Tracks a market restored from the ledger. Local stakes which hadn't been pushed before the restart are pushed
+        again with the next sync.
+
+        :param pushed: Dict of the stakes per team and login pushed to the backend, as recorded in the ledger.
+        """
+        self.track(market)
+        self.pushed[market.cycle] = pushed
+
+        for login, (team, amount) in market.pool.backers.items():
+            missing = amount - pushed.get(team, dict()).get(login, 0)
+
+            if missing > 0:
+                self.deltas[(market.cycle, team, login)] += missing
+
+    def market(self, cycle):
+        market_id = self.markets.get(cycle)
+        market = self.app.markets.get(market_id) if market_id else None
+
+        return market if market is not None and market.cycle == cycle else None
+
+    def add(self, market, team, login, amount):
+        if market.cycle in self.markets:
+            self.deltas[(market.cycle, team, login)] += amount
+
+    async def run(self):
+        while True:
+            await asyncio.sleep(self.interval)
+
+            try:
+                await self.sync()
+            except Exception:
+                logger.exception('Could not sync the shared pool')
+
+    async def sync(self):
+        deltas, self.deltas = self.deltas, Counter()
+
+        try:
+            with self.app.metrics.timer('shared_sync'):
+                stakes, cursors, settled = await self.backend.sync(
+                    self.node, [key + (amount,) for key, amount in deltas.items()], dict(self.cursors))
+        except Exception:
+            self.deltas.update(deltas)
+            raise
+
+        # The ledger keeps track of the pushed stakes, so the remaining ones can be pushed again after a restart
+        for (cycle, team, login), amount in deltas.items():
+            if cycle in self.pushed:
+                pushed = self.pushed[cycle].setdefault(team, dict())
+                pushed[login] = pushed.get(login, 0) + amount
+
+        if deltas:
+            self.app.record('shared_push', deltas=[list(key) + [amount] for key, amount in deltas.items()])
+
+        for cycle, seq in cursors.items():
+            market = self.market(cycle)
+
+            if market is None:
+                continue
+
+            self.cursors[cycle] = seq
+
+            for team, amount in stakes[cycle].items():
+                if team in market.pool.stack:
+                    market.pool.merge(team, amount)
+
+        for cycle, (status, winner) in settled.items():
+            # The market is closed right away, so no stake confirmed before finish() runs is added to it
+            market, late = self.close(cycle, status, winner)
+            asyncio.ensure_future(self.finish(cycle, market, status, winner, late))
+
+    async def settle(self, market, winner):
+        """
+        Settles the market's cycle for all instances, resolving it with the winner or resetting it if the winner is
+        None. The quota is computed from the stakes of all instances.
+
+        :return: Tuple of the quota and this instance's (login, amount) payouts, or None if another instance has
+                 settled the cycle already.
+        """
+        cycle = market.cycle
+        teams, margin, margin_relative = list(market.teams), market.pool.margin, market.pool.margin_relative
+        result = dict(quota=None)
+
+        def allocate(stakes):
+            if winner is None:
+                return [(node, login, amount) for node, team, login, amount in stakes]
+
+            pool = BetPool(teams, margin, margin_relative)
+
+            for node, team, login, amount in stakes:
+                if team in pool.stack:
+                    pool.add(team, (node, login), amount)
+
+            result['quota'] = pool.quota(winner)
+
+            return [(node, login, amount) for (node, login), amount in pool.payouts(winner) if amount > 0]
+
+        # Pushes the last stakes of this instance before the cycle is closed for good
+        await self.sync()
+        payouts = await self.backend.settle(self.node, cycle, winner, allocate)
+
+        if payouts is None:
+            return None
+
+        self.untrack(cycle)
+        return result['quota'], payouts
+
+    def close(self, cycle, status, winner):
+        """
+        Closes a market settled by another instance. Local stakes of the cycle which haven't been pushed yet weren't
+        part of the settlement, they are taken out of the deltas to be refunded.
+
+        :return: Tuple of the market, or None if it isn't active anymore, and a Counter of the late stakes per login.
+        """
+        market = self.market(cycle)
+        self.untrack(cycle)
+
+        late = Counter()
+
+        for key in [key for key in self.deltas if key[0] == cycle]:
+            late[key[2]] += self.deltas.pop(key)
+
+        # Also closes a market whose /resolvebet or /resetbet is still waiting for the backend
+        if market is not None:
+            market.bet_open = False
+            market.bet_current = False
+            self.app.markets.remove(market.id)
+            self.app.record('resolve' if status == 'resolved' else 'reset', market=market.id, team=winner)
+            self.app.archive_history(market, winner)
+            self.app.chat_queue.flush_announcements()
+
+            if status == 'resolved':
+                self.app.chat_queue.send('{}BET PAYOUTS!!! Team {} $FFFhas won the tournament.'
+                                         .format(market.prefix, market.label(winner)))
+            else:
+                self.app.chat_queue.send('{}BET IS CANCELLED! You\'ll receive your Planets back.'
+                                         .format(market.prefix))
+
+        return market, late
+
+    async def finish(self, cycle, market, status, winner, late):
+        # Sends the payouts of this instance for a cycle closed by close()
+        rows = await self.backend.take(self.node, cycle)
+        payouts = [(login, amount) for login, kind, amount in rows if kind == 'payout']
+        refunds = [(login, amount) for login, kind, amount in rows if kind != 'payout'] + list(late.items())
+
+        if payouts:
+            self.app.outbox.enqueue(
+                'payout', payouts, 'Bet payout from the server',
+                notice='$s$FFF//Bet$1EFMania$FFF: Congrats! You receive $222{amount} $FFFplanets as your bet payout.')
+
+        if refunds:
+            self.app.outbox.enqueue('refund', refunds, 'Bet payback from the server')
+
+        if market is not None and status == 'resolved':
+            # Stakes refunded as late weren't part of the settled bet and don't count as lost
+            late.update({login: amount for login, kind, amount in rows if kind == 'late'})
+            await self.app.record_stats(market, winner, payouts, late)
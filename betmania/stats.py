@@ -0,0 +1,89 @@
+import asyncio
+import datetime
+import logging
+
+from peewee import Case
+
+from .models import PlayerBetStats
+
+logger = logging.getLogger(__name__)
+
+
+class BetStats:
+    """
+    Per-player betting statistics stored in the PyPlanet database. The stats of all supporters of a resolved bet are
+    updated incrementally with one select, one insert and one update per chunk of players, instead of one query per
+    player.
+    """
+
+    def __init__(self, chunk_size=500):
+        self.chunk_size = chunk_size
+
+        # Bets resolved in quick succession share supporters. Without the lock both records could select a new player
+        # as missing and insert it twice, failing the whole chunk on the unique login.
+        self.lock = asyncio.Lock()
+
+    async def record(self, backers, winner, payouts):
+        """
+        Adds a resolved bet to the stats of its supporters.
+
+        :param backers: Dict of each supporter's (team, amount) stake, as kept by the pool.
+        :param winner: The winning team.
+        :param payouts: List of the (login, amount) payouts of the bet.
+        """
+        won = dict(payouts)
+        deltas = {login: (amount, won.get(login, 0), int(team == winner)) for login, (team, amount) in backers.items()}
+        logins = list(deltas)
+
+        try:
+            async with self.lock:
+                for i in range(0, len(logins), self.chunk_size):
+                    await self.write({login: deltas[login] for login in logins[i:i + self.chunk_size]})
+        except Exception:
+            logger.exception('Could not update the betting stats of {} players'.format(len(logins)))
+
+    async def write(self, deltas):
+        now = datetime.datetime.now()
+        rows = await PlayerBetStats.execute(
+            PlayerBetStats.select(PlayerBetStats.login).where(PlayerBetStats.login.in_(list(deltas))))
+        existing = {row.login for row in rows}
+
+        new = [dict(login=login, wagered=wagered, won=won, profit=won - wagered, bets=1, wins=wins, created_at=now,
+                    updated_at=now)
+               for login, (wagered, won, wins) in deltas.items() if login not in existing]
+
+        if new:
+            await PlayerBetStats.execute(PlayerBetStats.insert_many(new))
+
+        if existing:
+            # A single UPDATE adds each player's own delta, picked by a CASE on the login
+            def increment(field, delta):
+                return field + Case(PlayerBetStats.login, [(login, delta(*deltas[login])) for login in existing], 0)
+
+            await PlayerBetStats.execute(PlayerBetStats.update(
+                wagered=increment(PlayerBetStats.wagered, lambda wagered, won, wins: wagered),
+                won=increment(PlayerBetStats.won, lambda wagered, won, wins: won),
+                profit=increment(PlayerBetStats.profit, lambda wagered, won, wins: won - wagered),
+                wins=increment(PlayerBetStats.wins, lambda wagered, won, wins: wins),
+                bets=PlayerBetStats.bets + 1,
+                updated_at=now,
+            ).where(PlayerBetStats.login.in_(list(existing))))
+
+    async def get(self, login):
+        """
+        Returns the stats of a player and the player's rank by net profit, or (None, None) if the player has no stats.
+        """
+        rows = list(await PlayerBetStats.execute(PlayerBetStats.select().where(PlayerBetStats.login == login)))
+
+        if not rows:
+            return None, None
+
+        ahead = await PlayerBetStats.objects.count(
+            PlayerBetStats.select().where(PlayerBetStats.profit > rows[0].profit))
+
+        return rows[0], ahead + 1
+
+    async def top(self, limit=100):
+        # Served from the index on the profit column
+        return list(await PlayerBetStats.execute(
+            PlayerBetStats.select().order_by(PlayerBetStats.profit.desc(), PlayerBetStats.login).limit(limit)))
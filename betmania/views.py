@@ -1,7 +1,13 @@
-from pyplanet.contrib.player.exceptions import PlayerNotFound
+import asyncio
+import logging
+
 from pyplanet.views import TemplateView
 from pyplanet.views.generics.list import ManualListView
 
+from .history import sparkline
+
+logger = logging.getLogger(__name__)
+
 
 class SupportersListView(ManualListView):
     app = None
@@ -13,13 +19,17 @@ class SupportersListView(ManualListView):
 
     data = []
 
-    def __init__(self, app, team):
+    def __init__(self, app, market, team):
         super().__init__(self)
         self.app = app
         self.manager = app.context.ui
+        self.market = market
         self.team = team
         self.title = 'Supporters – Team ' + team
 
+        if not market.default:
+            self.title += ' (' + market.id + ')'
+
     async def get_fields(self):
         return [
             {
@@ -40,18 +50,101 @@ class SupportersListView(ManualListView):
         ]
 
     async def get_data(self):
-        items = []
+        ranking = self.market.pool.ranked(self.team)
+        nicknames = await self.app.nicknames.resolve([login for login, _ in ranking])
+
+        return [{'player_name': nicknames[login], 'bet_amount': amount} for login, amount in ranking]
+
+    async def get_object_data(self):
+        # Searching and custom ordering need the full list. Otherwise the page is served directly from the team's
+        # ranking, which is already sorted by bet amount.
+        if self.search_text or self.sort_field:
+            return await super().get_object_data()
+
+        start = (self.page - 1) * self.num_per_page
+        page = self.market.pool.ranked(self.team, start, start + self.num_per_page)
+        nicknames = await self.app.nicknames.resolve([login for login, _ in page])
+
+        self.count = len(self.market.pool.supporters[self.team])
+        self.objects = [{'player_name': nicknames[login], 'bet_amount': amount} for login, amount in page]
+
+        return {
+            'objects': self.objects,
+            'search': self.search_text,
+            'order': self.order,
+            'count': self.count,
+        }
 
-        for login in self.app.supporters[self.team]:
-            try:
-                player = await self.app.instance.player_manager.get_player(login)
-                supporter = player.nickname
-            except PlayerNotFound:
-                supporter = login
 
-            items.append({'player_name': supporter, 'bet_amount': self.app.supporters[self.team][login]})
+class BetLeaderboardView(ManualListView):
+    app = None
 
-        return items
+    title = 'BetMania – Leaderboard'
+    icon_style = 'Icons128x128_1'
+    icon_substyle = 'Statistics'
+
+    def __init__(self, app, limit=100):
+        super().__init__(self)
+        self.app = app
+        self.manager = app.context.ui
+        self.limit = limit
+
+    async def get_fields(self):
+        return [
+            {
+                'name': '#',
+                'index': 'rank',
+                'sorting': True,
+                'searching': False,
+                'width': 10,
+                'type': 'label'
+            },
+            {
+                'name': 'Player',
+                'index': 'player_name',
+                'sorting': False,
+                'searching': True,
+                'width': 60,
+                'type': 'label'
+            },
+            {
+                'name': 'Net Profit',
+                'index': 'profit',
+                'sorting': True,
+                'searching': False,
+                'width': 30
+            },
+            {
+                'name': 'Wagered',
+                'index': 'wagered',
+                'sorting': True,
+                'searching': False,
+                'width': 30
+            },
+            {
+                'name': 'Bets',
+                'index': 'bets',
+                'sorting': True,
+                'searching': False,
+                'width': 20
+            },
+            {
+                'name': 'Win Rate',
+                'index': 'win_rate',
+                'sorting': True,
+                'searching': False,
+                'width': 20
+            }
+        ]
+
+    async def get_data(self):
+        # Only the top of the ranking is read, served from the index on the profit column
+        rows = await self.app.stats.top(self.limit)
+        nicknames = await self.app.nicknames.resolve([row.login for row in rows])
+
+        return [{'rank': rank, 'player_name': nicknames[row.login], 'profit': row.profit, 'wagered': row.wagered,
+                 'bets': row.bets, 'win_rate': '{:.0f}%'.format(row.wins / row.bets * 100 if row.bets else 0)}
+                for rank, row in enumerate(rows, start=1)]
 
 
 class ServerInfoWidget(TemplateView):
@@ -72,6 +165,11 @@ class ServerInfoWidget(TemplateView):
         self.id = 'betmania__widget'
         self.manager = self.app.context.ui
 
+        self.interval = 0.5
+        self.fingerprint = None
+        self.failing = False
+        self.task = None
+
     async def on_start(self):
         self.commands = {
             'open_main_window': '/list',
@@ -79,22 +177,72 @@ class ServerInfoWidget(TemplateView):
 
     async def get_context_data(self):
         context = await super().get_context_data()
+        context.update(self.get_widget_data())
 
-        if self.app.bet_open:
+        return context
+
+    def get_widget_data(self):
+        # The widget shows the default market
+        market = self.app.markets.get()
+
+        if market.bet_open:
             bet_status = 'OPEN'
         else:
             bet_status = 'CLOSED'
 
-        context.update({
-            'bet_status': bet_status,
-            'current_stake': self.app.stake,
-        })
+        quotas = market.pool.quotas()
 
-        return context
+        return {
+            'bet_open': market.bet_open,
+            'bet_current': market.bet_current,
+            'bet_status': bet_status,
+            'current_stake': int(market.pool.stake),
+            'teams': [{'name': team, 'quota': quotas.get(team) or '-',
+                       'trend': sparkline([quota for quota in market.history.ordered(market.history.quotas[team])
+                                           if quota > 0], 10)} for team in market.teams],
+        }
 
     async def display(self, **kwargs):
         return await super().display(**kwargs)
 
+    def start(self):
+        if not self.task:
+            self.fingerprint = None
+            self.task = asyncio.ensure_future(self.run())
+
+    def stop(self):
+        if self.task:
+            self.task.cancel()
+            self.task = None
+
+    def get_fingerprint(self):
+        # Built from the rendered values only, a new history sample which doesn't change the trend isn't a change
+        data = self.get_widget_data()
+        return (data['bet_status'], data['bet_current'], data['current_stake'],
+                tuple((team['name'], team['quota'], team['trend']) for team in data['teams']))
+
+    async def run(self):
+        # Renders the widget at most once per interval and only if the bet state has changed since the last render.
+        # The context doesn't depend on the player, so a single manialink is sent to all players.
+        while True:
+            await asyncio.sleep(self.interval)
+            fingerprint = self.get_fingerprint()
+
+            if fingerprint != self.fingerprint:
+                self.fingerprint = fingerprint
+
+                try:
+                    await self.display()
+                except Exception:
+                    # Retried with the next interval, the failure is only logged once until a render succeeds
+                    if not self.failing:
+                        logger.exception('Could not render the BetMania widget')
+
+                    self.failing = True
+                    self.fingerprint = None
+                else:
+                    self.failing = False
+
     async def handle_catch_all(self, player, action, values, **kwargs):
         if action not in self.commands:
             return